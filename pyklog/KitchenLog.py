@@ -15,23 +15,37 @@ FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 details.
 """
 
-from os import remove, makedirs
+from bisect import bisect_left, bisect_right, insort
+from copy import copy
+from os import remove, makedirs, replace, fdopen, listdir, stat, getpid, kill
 
+import atexit
 import configparser
 import datetime
-import email
 import git
+import json
 import re
-import urllib.request
+import threading
+import time
 
 from email.mime.text import MIMEText
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 
+from contextlib import contextmanager
 from glob import glob
 from jinja2 import Template
-from os.path import join, normpath, expanduser, isdir
-
-from .LogEntry import LogEntry, parse_ymd, format_ymd
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
+from os.path import join, normpath, expanduser, isdir, isfile, dirname, getmtime
+from sys import intern
+
+from .MailParser import MailParser
+from .MediaStore import MediaStore, blob_id
+from .Metrics import metrics
+from .RWLock import RWLock
+from .Trigger import UpdateTrigger
+from .LogEntry import LogEntry, parse_ymd, format_ymd, mediadir, save_filename
 
 landing_page = Template(
 """====== Küchen-Log ======
@@ -53,7 +67,10 @@ month_page = Template(
 
 """)
 mail_end_marker = '%% END %%'
+mail_version = '# VERSION: %s'
+mail_version_pattern = re.compile(r'^# VERSION: (\w+)\s*$', re.MULTILINE)
 quopri_entry = re.compile(r'=\?[\w-]+\?[QB]\?[^?]+?\?=')
+search_word = re.compile(r'\w+')
 
 mail_greeting = 'Hi %s,\n'
 
@@ -86,11 +103,12 @@ subject line of your email, which contains a command and an optional date, and,
 depending on the command, some formatted content in the body of the mail.
 
 This is the list of available commands:
-  delete no
+  delete id
   info / help
   list
-  modify no
+  modify id
   new [date in Y-m-d format]
+  search words
 
 delete:
   Will remove the kitchen log entry that is provided as an argument.
@@ -99,11 +117,12 @@ info:
   shows you this page. The ids can be used for other commands.
 
 list:
-  return a list of all entries
+  return a list of all entries along with their ids, e.g. 2018-05-04-0
 
 modify:
   modifies the specified kitchen log entry. Returns the entry if no content is
-  provided.
+  provided. Reply with the amended entry, including its VERSION line, to change
+  it.
 
 new:
   create a new entry.
@@ -114,6 +133,9 @@ new:
   reply to the mail and amend changes as needed.
 
   Additional images may be attached as simple mail attachments.
+
+search:
+  return a list of all entries that contain all of the given words
 """
 
 mail_success_template = \
@@ -132,6 +154,14 @@ mail_delete_ok_template = \
 entry succesfully deleted. Find the content of the old entry below.
 """
 
+mail_failure_template = \
+"""
+I'm afraid I was unable to handle your mail: %s
+
+Nothing was changed. Please check the subject and the content of your mail,
+or try again later.
+"""
+
 
 def mail_delete_ok(recipient, old):
     return mail_greeting % recipient + mail_delete_ok_template + mail_footer + '\n--\n' + str(old)
@@ -139,11 +169,17 @@ def mail_delete_ok(recipient, old):
 
 def mail_list(recipient, entries):
     ret = (mail_greeting % recipient + mail_list_template).split('\n')
-    ret += ['  %d: %s' % x for x in entries]
+    ret += ['  %s: %s' % x for x in entries]
     ret.append(mail_footer)
     return '\n'.join(ret)
 
 
+def mail_search(recipient, query, entries):
+    if not entries:
+        return mail_greeting % recipient + '\nNo entries found for: %s\n' % query + mail_footer
+    return mail_list(recipient, entries)
+
+
 def mail_success(recipient, new):
     return mail_greeting % recipient + mail_success_template + mail_footer + '\n\n--\n' + new
 
@@ -185,18 +221,79 @@ def respond_email(address_from, mail, subject, response):
     return msg
 
 
-def load_entry(directory, file):
+def failure_email(address_from, mail, error):
+    # Reply to a mail that couldn't be handled, only its headers are looked
+    # at. Returns None if there is nobody to reply to.
+    try:
+        if isinstance(mail, bytes):
+            headers = BytesHeaderParser().parsebytes(mail)
+        else:
+            mail.seek(0)
+            headers = BytesHeaderParser().parse(mail)
+        if not headers['Reply-To'] and not headers['From']:
+            return None
+        recipient = re.sub(r' <.*@.*>', '', headers['From'] or '') or 'stranger'
+        subject = headers['Subject'] or '(no subject)'
+        return respond_email(address_from, headers, 'Error: %s' % subject,
+                             mail_greeting % recipient + mail_failure_template % str(error) + mail_footer)
+    except Exception as e:
+        print('Unable to reply to failed mail: %s' % str(e))
+        return None
+
+
+def entry_order(entry):
+    return entry.begin, entry.index
+
+
+def search_terms(text):
+    if not text:
+        return set()
+    return set(search_word.findall(text.lower()))
+
+
+def entry_terms(entry):
+    # Most words appear in many entries, share their strings
+    terms = search_terms(entry.topic) | search_terms(entry.appendix) | search_terms(entry.content)
+    return tuple(sorted(intern(x) for x in terms))
+
+
+def load_entry(directory, file, parsed=None, media=None):
     try:
-        entry = LogEntry.from_file(directory, file)
+        entry = LogEntry.from_file(directory, file, parsed, media)
     except Exception as e:
         print('Ignoring corrupt entry %s: %s' % (file, str(e)))
         return None
     return entry
 
 
-def save_filename(content, file):
-    with open(file, 'w') as f:
-        f.write(content)
+def process_alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clean_staging(directory, max_age):
+    # Every process stages attachments in a directory of its own, named
+    # after its pid. Remove those of processes that are gone, and whatever
+    # is too old to be still needed.
+    now = time.time()
+    for name in listdir(directory):
+        path = join(directory, name)
+        try:
+            pid = name.split('-', 1)[0]
+            gone = isdir(path) and pid.isdigit() and not process_alive(int(pid))
+            if not gone and now - getmtime(path) < max_age:
+                continue
+            if isdir(path):
+                rmtree(path)
+            else:
+                remove(path)
+        except OSError as e:
+            print('Unable to clean up %s: %s' % (path, str(e)))
 
 
 def decode_payload(message_part):
@@ -234,7 +331,11 @@ class Config:
         try:
             self.d_cache = config.get('klog', 'cache')
             self.kitchenlog_uri = config.get('klog', 'kitchenlog')
-            self._update_trigger = config.get('klog', 'update_trigger')
+            update_trigger = config.get('klog', 'update_trigger')
+            update_timeout = config.getfloat('klog', 'update_timeout', fallback=10)
+            update_retries = config.getint('klog', 'update_retries', fallback=3)
+            update_debounce = config.getfloat('klog', 'update_debounce', fallback=2)
+            self.sync_interval = config.getfloat('klog', 'sync_interval', fallback=300)
 
             if needs_email:
                 self.smtp_server = config.get('klog', 'smtp_server')
@@ -256,96 +357,715 @@ class Config:
             self.repo = git.Repo(self.d_repo)
 
         # Update repository
+        self.sync = sync
         if sync:
             print('Updating repo...')
             self.repo.remote('origin').pull()
 
+        self.trigger = UpdateTrigger(update_trigger, timeout=update_timeout, retries=update_retries,
+                                     debounce=update_debounce)
+
     def update_trigger(self):
-        try:
-            urllib.request.urlopen(self._update_trigger)
-        except Exception as e:
-            print('Update trigger error: %s' % str(e))
+        self.trigger.fire()
 
 
 class KitchenLog:
     FILES_GLOB = join('20*', '*', '*.txt')
+    FILES_PATTERN = re.compile(r'^20[^/]*/[^/]+/[^/]+\.txt$')
+    MEDIA_PATTERN = re.compile(r'^media/(\d+)/(\d+)/(\d+)/(\d+)/[^/]+$')
+    KEY_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})-(\d+)$')
+    CACHE_VERSION = 2
+    STAGING_MAX_AGE = 7 * 24 * 3600
 
-    def __init__(self, repo):
+    def __init__(self, repo, cache=None):
         self.repo = repo
         self._directory = normpath(repo.working_dir)
-        self._reload()
+        self._head = None
+        self._head_date = None
+        self._signature = None
+        self._staged = set()
+        self._staging_root = join(repo.git_dir, 'klog-staging')
+        self._staging = None
+        self._media_store = MediaStore(repo)
+        self._odb_lock = threading.Lock()
+        # Shared by all entries instead of a bound method each
+        self._reader = self._read_blob
+        # Writers are serialised by _writer and only take the exclusive side
+        # of _lock while they touch the in-memory state, never while waiting
+        # for git. Readers hold the shared side while they look at entries.
+        self._writer = threading.RLock()
+        self._lock = RWLock()
+        self._generation = 0
+        self._blobs = dict()
+        # Records of entries.json, only kept while they are needed: all of
+        # them while the entries are built, afterwards only those that
+        # still have to be written
+        self._cache = dict()
+        self._cache_complete = False
+        self._cache_file = None
+        self._cache_dirty = False
+        if cache:
+            self._cache_file = join(cache, 'entries.json')
+
+        # Attachments of mails that were never committed
+        makedirs(self._staging_root, exist_ok=True)
+        clean_staging(self._staging_root, KitchenLog.STAGING_MAX_AGE)
+
+        with self._writer:
+            self._reload()
+
+    def _staging_dir(self):
+        # Private to this process, created on first use
+        if not self._staging or not isdir(self._staging):
+            makedirs(self._staging_root, exist_ok=True)
+            self._staging = mkdtemp(prefix='%d-' % getpid(), dir=self._staging_root)
+            atexit.register(rmtree, self._staging, True)
+        return self._staging
+
+    def _load_cache(self):
+        if not self._cache_file:
+            return dict()
+        try:
+            with open(self._cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        if cache.get('version') != KitchenLog.CACHE_VERSION:
+            return dict()
+        return cache['entries']
+
+    def _save_cache(self):
+        # The records duplicate what the entries hold, let go of them
+        records = self._cache
+        complete = self._cache_complete
+        self._cache = dict()
+        self._cache_complete = False
+        if not self._cache_file or not self._cache_dirty:
+            return
+        self._cache_dirty = False
+
+        # Only records that changed since the last save are at hand
+        if not complete:
+            records = dict(self._load_cache(), **records)
+        blobs = set(self._blobs.values())
+        records = {x: y for x, y in records.items() if x in blobs}
+        # The cache is only an optimisation, failing to write it is not fatal.
+        # Other processes sharing the cache directory write files of their own.
+        tmp = None
+        try:
+            fd, tmp = mkstemp(dir=dirname(self._cache_file))
+            with fdopen(fd, 'w') as f:
+                json.dump({'version': KitchenLog.CACHE_VERSION, 'entries': records}, f)
+            replace(tmp, self._cache_file)
+        except OSError as e:
+            print('Unable to save cache: %s' % str(e))
+            if tmp and isfile(tmp):
+                remove(tmp)
+
+    def _tracked_objects(self, *paths):
+        # Maps paths to their object ids in HEAD. Paths that differ in the
+        # working tree, and all of their parents, are mapped to None.
+        if not self._cache_file:
+            return dict()
+
+        try:
+            listing = self.repo.git.ls_tree('-r', '-t', '-z', 'HEAD', '--', *paths)
+            status = self.repo.git.status('--porcelain', '-z', '--untracked-files=all', '--', *paths)
+        except git.GitCommandError:
+            return dict()
+
+        objects = dict()
+        for line in filter(None, listing.split('\0')):
+            meta, path = line.split('\t', 1)
+            objects[path] = meta.split(' ')[2]
+
+        status = iter(status.split('\0'))
+        for line in status:
+            if not line:
+                continue
+            changed = [line[3:]]
+            if line[0] in 'RC':
+                changed.append(next(status, ''))
+            for path in changed:
+                while path:
+                    objects[path] = None
+                    path = dirname(path)
+
+        return objects
+
+    @staticmethod
+    def _media_tree(objects, directory, complete):
+        # An untracked media directory has no tree only if we have the whole
+        # listing of HEAD at hand
+        if complete:
+            return objects.get(directory, '')
+        return objects.get(directory)
+
+    def _load(self, file, objects, complete):
+        # Returns the entry and its search terms. Entries from the cache
+        # come without their content, it is loaded on demand.
+        blob = objects.get(file)
+        self._blobs.pop(file, None)
+
+        record = self._cache.get(blob) if blob else None
+        media = None
+        metrics.count('cache_hits' if record else 'cache_misses')
+        if record:
+            parsed = parse_ymd(record['begin']), parse_ymd(record['end']), \
+                     dict(record['headers']), None
+            tree = self._media_tree(objects, mediadir(parsed[0], LogEntry.index_of(file)), complete)
+            if tree is not None and tree == record['media_tree']:
+                media = record['media']
+            entry = load_entry(self._directory, file, parsed, media)
+            terms = record['terms'] = tuple(intern(x) for x in record['terms'])
+        else:
+            entry = load_entry(self._directory, file)
+            terms = entry_terms(entry) if entry else None
+
+        if entry and blob:
+            self._blobs[file] = blob
+            if media is None:
+                self._update_record(entry, terms, objects, complete)
+            entry.unload(blob, self._reader)
+        return entry, terms
+
+    def _read_blob(self, blob):
+        # The object database talks to a single git cat-file process, every
+        # access to it has to hold _odb_lock
+        with self._odb_lock:
+            return self.repo.odb.stream(bytes.fromhex(blob)).read().decode()
+
+    def _update_record(self, entry, terms, objects, complete):
+        blob = self._blobs.get(entry.path)
+        if not blob:
+            return
 
-    def _reload(self):
+        record = {
+            'begin': entry.begin_ymd,
+            'end': entry.end_ymd,
+            'headers': entry.headers,
+            'terms': terms,
+            'media': list(entry.media),
+            'media_tree': self._media_tree(objects, entry.mediadir, complete),
+        }
+        if self._cache.get(blob) != record:
+            self._cache[blob] = record
+            self._cache_dirty = True
+
+    def _head_commit(self):
+        try:
+            return self.repo.head.commit.hexsha
+        except ValueError:
+            # empty repository, no commits yet
+            return None
+
+    def _head_signature(self):
+        # Cheap fingerprint of HEAD. Git replaces these files whenever a ref
+        # moves, so a commit of any process changes the signature.
+        git_dir = self.repo.git_dir
+        files = [join(git_dir, 'HEAD'), join(git_dir, 'packed-refs')]
+        try:
+            with open(files[0]) as f:
+                head = f.read().strip()
+            if head.startswith('ref: '):
+                files.append(join(git_dir, head[5:]))
+        except OSError:
+            pass
+
+        signature = list()
+        for file in files:
+            try:
+                st = stat(file)
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    @metrics.timed('reload')
+    def _reload(self, since=None):
+        # Commits, our own ones as well, may change media behind the store
+        self._media_store.invalidate()
+        self._signature = self._head_signature()
+        head = self._head_commit()
+        changes = None
+        if since and head:
+            try:
+                changes = self.repo.git.diff('--name-status', '--no-renames', '-z', since, head)
+            except git.GitCommandError as e:
+                print('Falling back to full reload: %s' % str(e))
+
+        if changes is None:
+            self._reload_full()
+        else:
+            self._reload_changes(changes)
+        if head != self._head:
+            with self._odb_lock:
+                self._head_date = self.repo.head.commit.committed_datetime if head else None
+        self._head = head
+        with metrics.timer('reload.save_cache'):
+            self._save_cache()
+
+    def _reload_full(self):
         target_entries = glob(join(self._directory, KitchenLog.FILES_GLOB))
         target_entries = [x[(len(self._directory) + 1):] for x in target_entries]
-        self._entries = [load_entry(self._directory, x) for x in target_entries]
-        self._entries = list(filter(None, self._entries))
-        self._entries.sort(key=lambda x: x.begin, reverse=True)
+        files = dict()
+        self._blobs = dict()
+        with metrics.timer('reload.git'):
+            objects = self._tracked_objects()
+        # Every entry ends up with a record, all of them are written at once
+        with metrics.timer('reload.load_cache'):
+            self._cache = dict(self._load_cache(), **self._cache)
+        self._cache_complete = True
+        terms = dict()
+        with metrics.timer('reload.load'):
+            for file in target_entries:
+                entry, terms[file] = self._load(file, objects, True)
+                if entry:
+                    files[file] = entry
+        metrics.count('entries_loaded', len(files))
+        entries = list(files.values())
+        entries.sort(key=entry_order, reverse=True)
+
+        with self.editing():
+            self._files = files
+            self._entries = entries
+            self._years = dict()
+            self._dates = list()
+            self._by_date = dict()
+            self._max_span = datetime.timedelta(0)
+            self._terms = dict()
+            self._indexed = dict()
+            with metrics.timer('reload.index'):
+                for entry in reversed(entries):
+                    self._index_add(entry, terms[entry.path], False)
+
+    def _reload_changes(self, changes):
+        changes = changes.split('\0')
+        changes = zip(changes[0::2], changes[1::2])
+
+        reload_files = set()
+        media_files = set()
+        for status, path in changes:
+            if KitchenLog.FILES_PATTERN.match(path):
+                reload_files.add(path)
+                continue
+            media = KitchenLog.MEDIA_PATTERN.match(path)
+            if media:
+                year, month, day, index = media.groups()
+                media_files.add('%s/%s/%s-%d.txt' % (year, month, day, int(index)))
+
+        self._reload_files(reload_files, media_files)
+
+    def _reload_files(self, reload_files, media_files=frozenset()):
+        media_files = {x for x in media_files - reload_files if x in self._files}
+        objects = dict()
+        if reload_files or media_files:
+            paths = reload_files | media_files
+            paths |= {LogEntry.mediadir_of(x) for x in paths}
+            paths |= {self._files[x].mediadir for x in media_files}
+            objects = self._tracked_objects(*paths)
+
+        loaded = dict()
+        for file in reload_files:
+            self._blobs.pop(file, None)
+            if isfile(join(self._directory, file)):
+                entry, terms = self._load(file, objects, False)
+                if entry:
+                    loaded[file] = entry, terms
+
+        media = {x: self._files[x].list_media() for x in media_files}
+
+        with self.editing():
+            for file in reload_files:
+                self._files.pop(file, None)
+                if file in loaded:
+                    self._files[file] = loaded[file][0]
+
+            for file in media_files:
+                entry = self._files[file]
+                entry.refresh_media(media[file])
+                self._update_record(entry, self._indexed[entry][1], objects, False)
+
+            # Drop replaced entries as well as entries that were never saved
+            entries = list()
+            for entry in self._entries:
+                if self._files.get(entry.path) is entry:
+                    entries.append(entry)
+                else:
+                    self._index_remove(entry)
+            for entry, terms in loaded.values():
+                self._index_add(entry, terms)
+
+            entries += [x for x, _ in loaded.values()]
+            entries.sort(key=entry_order, reverse=True)
+            self._entries = entries
+
+    def _index_add(self, entry, terms, sort=True):
+        # Without sorting, entries must be added in ascending order
+        begin = entry.begin
+        self._indexed[entry] = begin, terms
+        for term in terms:
+            self._terms.setdefault(term, set()).add(entry)
+
+        entries = self._years.setdefault(begin.year, dict()).setdefault(begin.month, list())
+        entries.insert(0, entry)
+        if sort:
+            entries.sort(key=entry_order, reverse=True)
+
+        if begin not in self._by_date:
+            self._by_date[begin] = list()
+            if sort:
+                insort(self._dates, begin)
+            else:
+                self._dates.append(begin)
+        entries = self._by_date[begin]
+        entries.insert(0, entry)
+        if sort:
+            entries.sort(key=entry_order, reverse=True)
 
-    def commit(self, message, no_sync=False):
-        dirty = [x for x in self._entries if x.dirty]
-        if len(dirty) == 0:
+        if entry.end and entry.end - begin > self._max_span:
+            self._max_span = entry.end - begin
+
+    def _index_remove(self, entry):
+        if entry not in self._indexed:
             return
 
-        list(map(lambda x: x.save(), dirty))
-        self._export_dokuwiki()
+        begin, terms = self._indexed.pop(entry)
+        for term in terms:
+            self._terms[term].discard(entry)
+            if not self._terms[term]:
+                del self._terms[term]
+
+        months = self._years[begin.year]
+        months[begin.month].remove(entry)
+        if not months[begin.month]:
+            del months[begin.month]
+        if not months:
+            del self._years[begin.year]
+
+        self._by_date[begin].remove(entry)
+        if not self._by_date[begin]:
+            del self._by_date[begin]
+            del self._dates[bisect_left(self._dates, begin)]
+
+    @metrics.timed('stage')
+    def stage(self):
+        # Writes dirty entries to disk without committing them
+        with self.writing():
+            dirty = [x for x in self._entries if x.dirty]
+            if len(dirty) == 0:
+                return
+
+            # Copies are saved, hashing and writing files takes a while.
+            # Readers keep seeing the entries as they are until the saved
+            # ones are swapped in by _reload_files().
+            saved = [copy(x) for x in dirty]
+
+            # Entries may move on save, so track both their old and new location
+            files = {x.path for x in saved}
+            try:
+                list(map(lambda x: x.save(self._media_store), saved))
+            except:
+                # Entries saved so far must not end up in the next commit.
+                # Files staged before are left alone, they hold changes of
+                # their own.
+                files |= {x.path for x in saved}
+                files.discard(None)
+                self._restore(files - self._staged)
+                raise
+            files |= {x.path for x in saved}
+            files.discard(None)
+
+            # References held by callers follow the entries to their new location
+            with self.editing():
+                for entry, clone in zip(dirty, saved):
+                    entry.assign(clone)
+
+            self._reload_files(files)
+            self._staged |= files
+
+    def commit(self, message, no_sync=False):
+        with self.writing():
+            self.stage()
+            if len(self._staged) == 0:
+                return
 
-        self.repo.git.add('-A')
-        self.repo.git.commit('--allow-empty', '-m', message)
-        if not no_sync:
-            self.repo.git.push('origin')
+            staged = self._staged
+            self._export_dokuwiki(staged)
+            self._staged = set()
 
-        self._reload()
+            try:
+                with metrics.timer('git.add'):
+                    self.repo.git.add('-A')
+                with metrics.timer('git.commit'):
+                    self.repo.git.commit('--allow-empty', '-m', message)
+            except:
+                # Still not committed, revert() may throw it away
+                self._staged |= staged
+                raise
+            if not no_sync:
+                with metrics.timer('git.push'):
+                    self.repo.git.push('origin')
+            metrics.count('commits')
+
+            self._reload(self._head)
+
+    def discard(self):
+        # Throw away uncommitted changes, e.g. after a failed request
+        with self.writing():
+            with self.editing():
+                dirty = [x for x in self._entries if x.dirty]
+                for entry in dirty:
+                    entry.drop_staged_media()
+            self._reload_files({x.path for x in dirty if x.path})
+
+    def refresh(self):
+        # Picks up commits of other processes sharing the repository, e.g.
+        # klog or klogd. Returns whether anything had to be reloaded.
+        if self._head_signature() == self._signature:
+            return False
+
+        # A busy writer is about to reload anyway, don't wait for its git
+        # commands. Whatever it doesn't cover is picked up next time.
+        if not self._writer.acquire(blocking=False):
+            return False
+        try:
+            signature = self._head_signature()
+            if self._head_commit() == self._head:
+                self._signature = signature
+                return False
+
+            metrics.count('external_reloads')
+            self._reload(self._head)
+        finally:
+            self._writer.release()
+        return True
+
+    def revert(self):
+        # Like discard(), but also restores staged entries on disk to HEAD,
+        # e.g. after a failed commit whose changes are going to be redone
+        with self.writing():
+            self.discard()
+            if not self._staged:
+                return
+
+            self._restore(self._staged, {'dokuwiki'})
+            self._reload_files(self._staged)
+            self._staged = set()
+
+    def _restore(self, files, paths=frozenset()):
+        # Restores entry files, their media and paths on disk to HEAD
+        if not files and not paths:
+            return
+        paths = set(paths)
+        for file in files:
+            paths |= {file, LogEntry.mediadir_of(file)}
+        paths = sorted(paths)
+        tracked = self.repo.git.ls_tree('--name-only', 'HEAD', '--', *paths).split('\n')
+        self.repo.git.reset('-q', 'HEAD', '--', *paths)
+        if any(tracked):
+            self.repo.git.checkout('HEAD', '--', *filter(None, tracked))
+        self.repo.git.clean('-fdq', '--', *paths)
+        self._media_store.invalidate()
+
+    def reading(self):
+        # Held while looking at entries, e.g. for rendering a page
+        return self._lock.shared()
+
+    def writing(self):
+        # Serialises writers without blocking readers
+        return self._writer
+
+    @contextmanager
+    def editing(self):
+        # Held while changing entries or indexes, blocks readers
+        with self._writer, self._lock.exclusive():
+            try:
+                yield
+            finally:
+                self._generation += 1
 
     def get(self, date):
-        return [x for x in self._entries if x._begin == date]
-
-    def get_no(self, no):
-        if no < len(self._entries):
-            return self._entries[no]
-        return None
+        return list(self._by_date.get(date, []))
+
+    def get_range(self, start, end):
+        return self.page(start, end)[0]
+
+    def page(self, start=None, end=None, after=None, limit=None):
+        # Entries overlapping [start, end], start and end are optional.
+        # Multi-day entries may begin up to _max_span before start. The result
+        # is cut into pages: after is the key of the last entry of the previous
+        # page, the entry doesn't need to exist anymore. Returns the entries
+        # and whether there are more.
+        dates = self._dates
+        lo = 0 if start is None else bisect_left(dates, start - self._max_span)
+        hi = len(dates) if end is None else bisect_right(dates, end)
+        if after:
+            match = KitchenLog.KEY_PATTERN.match(after)
+            if not match:
+                raise ValueError('Invalid key: %s' % after)
+            year, month, day, index = map(int, match.groups())
+            after = datetime.datetime(year, month, day), index
+            hi = min(hi, bisect_right(dates, after[0]))
+
+        ret = list()
+        for i in range(hi - 1, lo - 1, -1):
+            for entry in self._by_date[dates[i]]:
+                if after and (entry.begin, entry.index) >= after:
+                    continue
+                if start is not None and max(entry.begin, entry.end or entry.begin) < start:
+                    continue
+                if limit and len(ret) == limit:
+                    return ret, True
+                ret.append(entry)
+        return ret, False
+
+    def blob(self, entry):
+        # Object id of the entry in HEAD, None if unknown or changed since
+        if entry.dirty or not entry.path:
+            return None
+        return self._blobs.get(entry.path)
+
+    def version(self, entry):
+        # Changes with every change of the entry, also when its key is reused
+        return self.blob(entry) or blob_id(str(entry).encode())
+
+    def get_key(self, key):
+        match = KitchenLog.KEY_PATTERN.match(key or '')
+        if not match:
+            return None
+        year, month, day, index = match.groups()
+        return self._files.get('%s/%s/%s-%d.txt' % (year, month, day, int(index)))
+
+    def search(self, query):
+        terms = search_terms(query)
+        if not terms:
+            return list()
+
+        # Intersect starting with the rarest term
+        hits = sorted((self._terms.get(x, set()) for x in terms), key=len)
+        ret = set(hits[0])
+        for hit in hits[1:]:
+            ret &= hit
+        return sorted(ret, key=entry_order, reverse=True)
 
     def new_entry(self, date):
         entry = LogEntry.new(self._directory, date)
-        self._entries.append(entry)
+        with self.editing():
+            self._entries.append(entry)
         return entry
 
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def head(self):
+        return self._head
+
+    @property
+    def head_date(self):
+        return self._head_date
+
+    @property
+    def generation(self):
+        # Changes whenever the in-memory state did
+        return self._generation
+
     def years_dict(self):
-        dates = {entry.begin for entry in self._entries}
-        years = dict()
-        for year in {x.year for x in dates}:
-            years[year] = {
-                x.month:
-                    [entry for entry in self._entries
-                     if entry.begin.year == year and entry.begin.month == x.month]
-                for x in dates
-                if x.year == year}
-        return years
-
-    def _export_dokuwiki(self):
+        return self._years
+
+    def years(self):
+        # Years with entries and their number of entries, newest first
+        return [(year, sum(len(x) for x in months.values()))
+                for year, months in sorted(self._years.items(), reverse=True)]
+
+    def year(self, year):
+        # Entries of a year by month, None if there aren't any
+        return self._years.get(year)
+
+    @metrics.timed('export')
+    def _export_dokuwiki(self, files=None):
         target_path = join(self._directory, 'dokuwiki')
         makedirs(target_path, exist_ok=True)
-        # delete old data
-        target_entries = glob(join(target_path, 'entry', KitchenLog.FILES_GLOB))
-        target_entries += glob(join(target_path, '*.txt'))
-        for target in target_entries:
-            remove(target)
+        years = self.years_dict()
 
-        for entry in self._entries:
-            entry.to_dokuwiki(target_path)
+        if files is None:
+            entries = self._entries
+            months = {(year, month) for year, x in years.items() for month in x}
+        else:
+            entries = [self._files[x] for x in files if x in self._files]
+            months = {tuple(int(y) for y in x.split('/')[0:2]) for x in files}
+            months |= {(x.begin.year, x.begin.month) for x in entries}
 
-        years = self.years_dict()
+        outputs = set()
+        for entry in entries:
+            outputs.add(entry.to_dokuwiki(target_path))
 
-        for year, months in years.items():
-            for month, entries in months.items():
-                month_rendered = month_page.render(date=entries[0].begin)
-                save_filename(month_rendered, join(target_path, '%d-%02d.txt'% (year, month)))
+        for year, month in months:
+            target = join(target_path, '%d-%02d.txt' % (year, month))
+            if month in years.get(year, {}):
+                month_rendered = month_page.render(date=years[year][month][0].begin)
+                save_filename(month_rendered, target)
+                outputs.add(target)
 
         lp = landing_page.render(content=years)
         save_filename(lp, join(target_path, 'start.txt'))
+        outputs.add(join(target_path, 'start.txt'))
 
+        # delete orphaned data
+        if files is None:
+            stale = glob(join(target_path, 'entry', KitchenLog.FILES_GLOB))
+            stale += glob(join(target_path, '*.txt'))
+        else:
+            stale = [join(target_path, 'entry', x) for x in files]
+            stale += [join(target_path, '%d-%02d.txt' % x) for x in months]
+        for target in stale:
+            if target not in outputs and isfile(target):
+                remove(target)
+
+    def handle_emails(self, address_from, mails):
+        # Handles a batch of mails, changes are staged for a single commit.
+        # The responses confirm changes, only send them once they are committed.
+        # Also returns the positions of mails that couldn't be handled at all.
+        update_repo = False
+        responses = list()
+        failed = list()
+        with self.writing():
+            for no, mail in enumerate(mails):
+                try:
+                    with self.editing():
+                        update, response = self.handle_email(address_from, mail)
+                    if update:
+                        self.stage()
+                except Exception as e:
+                    print('Failed to handle mail: %s' % str(e))
+                    self.discard()
+                    failed.append(no)
+                    response = failure_email(address_from, mail, e)
+                    if response:
+                        responses.append(response)
+                    continue
+
+                if update:
+                    update_repo = True
+                else:
+                    self.discard()
+                responses.append(response)
+
+        return update_repo, responses, failed
+
+    @metrics.timed('handle_email')
     def handle_email(self, address_from, mail):
-        mail = email.message_from_bytes(mail)
+        # Accepts raw bytes or a binary file
+        metrics.count('mails')
+        mail = MailParser(self._staging_dir()).parse(mail)
+        try:
+            return self._handle_email(address_from, mail)
+        finally:
+            # Attachments that didn't end up in an entry
+            mail.drop_staged()
+
+    def _handle_email(self, address_from, mail):
         subject = normalise_subject(mail)
         update_repo = False
 
@@ -362,9 +1082,8 @@ class KitchenLog:
             try:
                 entry.reload(content, True)
                 for attachment in attachments:
-                    attachment_raw = attachment.get_payload(decode=True)
                     filename = decode_multiple(attachment.get_filename())
-                    entry.attach_media(filename, attachment_raw)
+                    entry.attach_media_by_file(attachment.take_staged(), filename, staged=True)
             except ValueError as e:
                 return False, error_respond('Parser error: %s\n\nOriginal mail below\n--\n\n%s' % (str(e), content))
             return True, mail_success(recipient, str(entry))
@@ -373,11 +1092,11 @@ class KitchenLog:
         if len(split_subject) == 1:
             command = split_subject[0]
             argument = None
-        elif len(split_subject) == 2:
+        elif len(split_subject) == 2 or split_subject[0].lower() == 'search':
             command = split_subject[0]
-            argument = split_subject[1]
+            argument = ' '.join(split_subject[1:])
         else:
-            return error_respond('Invalid command: ' % subject)
+            return error_respond('Invalid command: %s' % subject)
 
         content = None
         attachments = list()
@@ -412,28 +1131,33 @@ class KitchenLog:
             response = mail_info(recipient)
         elif command == 'list':
             entries = list()
-            for i, entry in enumerate(self._entries):
-                entries.append((i, entry.shortlog))
+            for entry in self._entries:
+                entries.append((entry.key, entry.shortlog))
 
             response = mail_list(recipient, entries)
+        elif command == 'search':
+            entries = [(x.key, x.shortlog) for x in self.search(argument)]
+            response = mail_search(recipient, argument, entries)
         elif command == 'delete' or command == 'modify':
-            if False in [x.isnumeric() for x in argument]:
-                error_respond('Not an integer: %s' % argument)
-
-            no = int(argument)
-            if no >= len(self._entries):
-                error_respond('Index out of bound: %d' % no)
-
-            entry = self._entries[no]
+            entry = self.get_key(argument)
+            if not entry:
+                return error_respond('Unknown or outdated id: %s. Use the list command to get current ids.'
+                                     % argument)
 
             if command == 'delete':
                 entry.remove()
                 response = mail_delete_ok(recipient, str(entry))
             elif command == 'modify':
                 if found_entry:
+                    # Keys of deleted entries are reused, don't apply an edit
+                    # of one to the other
+                    version = mail_version_pattern.search(content)
+                    if not version or version.group(1) != self.version(entry):
+                        return error_respond('Entry %s changed since you requested it. Use "modify %s" to get its '
+                                             'current version.' % (argument, argument))
                     update_repo, response = replace_entry(entry, content, attachments)
                 else:
-                    response = str(entry) + '\n' + mail_end_marker
+                    response = '\n'.join([mail_version % self.version(entry), str(entry), mail_end_marker])
             update_repo = True
         elif command == 'new':
             if argument:
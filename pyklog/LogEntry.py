@@ -15,13 +15,19 @@ FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 details.
 """
 
+import re
+
 from datetime import datetime
+from functools import lru_cache
 from glob import glob
 
 from jinja2 import Template
-from os.path import join, isfile, split
-from os import makedirs, remove
-from os.path import splitext, dirname, basename
+from os.path import join, isfile, isdir, exists, split
+from os import makedirs, remove, rename
+from os.path import splitext, dirname, basename, relpath
+
+from .MediaStore import install
+from .Metrics import metrics
 
 dokuwiki_log_template = Template(
 """===== {{ content.topic }}: {{ content.wikidate }} {% if content.appendix %}({{ content.appendix }}){% endif %} =====
@@ -31,7 +37,6 @@ dokuwiki_log_template = Template(
 {{ content.gallery }}
 {% endif %}
 """)
-image_url = 'https://raw.githubusercontent.com/Binary-Kitchen/kitchenlog/master/'
 
 log_entry_template = Template(
 """# Nach den headern muss eine Leerzeile folgen. Alle header sind anpassbar.
@@ -53,13 +58,27 @@ def parse_defval(value):
     return value
 
 
+ymd_pattern = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})', re.ASCII)
+# try_parse used to unpack header lines, keep its error message
+unpack_error = 'not enough values to unpack (expected 2, got 1)'
+
+
+@lru_cache(maxsize=8192)
+def _parse_ymd(value):
+    # Plain ISO dates don't need the full strptime machinery
+    match = ymd_pattern.fullmatch(value)
+    try:
+        if match:
+            return datetime(*[int(x) for x in match.groups()])
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
 def parse_ymd(value):
     value = parse_defval(value)
     if value:
-        try:
-            value = datetime.strptime(value, '%Y-%m-%d')
-        except ValueError:
-            return None
+        return _parse_ymd(value)
     return value
 
 
@@ -82,25 +101,56 @@ def format_german_date(dt, print_year):
     return dt.strftime(format)
 
 
+def save_filename(content, file):
+    # Leave files alone that wouldn't change
+    try:
+        with open(file, 'r') as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+
+    with open(file, 'w') as f:
+        f.write(content)
+    return True
+
+
 def mediadir(date, index):
     return join('media', date.strftime('%Y/%m/%d'), str(index))
 
 
+# Shared by all entries without pending media changes
+no_changes = frozenset()
+
+
 class LogEntry:
-    def __init__(self, content, index, directory):
+    # All entries of the log stay in memory, keep them small. The content
+    # of unmodified entries can be dropped with unload(), it is read again
+    # from the committed blob on access. The working tree is shared with
+    # other processes and may hold changes they didn't commit yet.
+    __slots__ = ['_remove', '_filename', '_filename_date', '_dirty', '_directory', '_removed_media',
+                 '_added_media', '_staged_media', '_index', '_begin', '_end', '_headers', '_content',
+                 '_media', '_blob', '_reader']
+
+    def __init__(self, content, index, directory, parsed=None, media=None):
         self._remove = False
         self._filename = None
         self._filename_date = None
         self._dirty = False
         self._directory = directory
-        self._removed_media = set()
-        self._added_media = set()
+        self._removed_media = no_changes
+        self._added_media = no_changes
+        self._staged_media = no_changes
         self._index = index
-        self._begin, self._end, self._headers, self._content, = LogEntry.try_parse(content)
-
-        media = glob(join(self._directory, self.mediadir, '*'))
-        self._media = [basename(x) for x in media]
-
+        self._blob = None
+        self._reader = None
+        if parsed is None:
+            parsed = LogEntry.try_parse(content)
+        self._begin, self._end, self._headers, self._content, = parsed
+        if media is None:
+            self.refresh_media()
+        else:
+            self._media = list(media)
 
     @property
     def dirty(self):
@@ -114,6 +164,10 @@ class LogEntry:
     def media(self):
         return self._media
 
+    @property
+    def headers(self):
+        return self._headers
+
     @property
     def topic(self):
         return self._headers['TOPIC']
@@ -122,6 +176,23 @@ class LogEntry:
     def appendix(self):
         return self._headers['APPENDIX']
 
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def key(self):
+        # Stable as long as the entry stays at its location on disk
+        if not self._filename:
+            return None
+        return '%s-%d' % (format_ymd(self._filename_date), self._index)
+
+    @property
+    def path(self):
+        if not self._filename:
+            return None
+        return relpath(self._filename, self._directory)
+
     @property
     def begin_ymd(self):
         return format_ymd(self._begin)
@@ -144,8 +215,18 @@ class LogEntry:
 
     @property
     def content(self):
+        if self._content is None:
+            self._content = LogEntry.try_parse(self._reader(self._blob))[3]
         return self._content
 
+    def unload(self, blob, reader):
+        # blob is the object id of the entry in HEAD, reader(blob) returns
+        # its text. Only unmodified entries can be read again.
+        self._blob = blob
+        self._reader = reader
+        if blob and self._filename and not self.dirty:
+            self._content = None
+
     @property
     def mediadir(self):
         return mediadir(self._begin, self._index)
@@ -180,15 +261,29 @@ class LogEntry:
 
         self._filename_date = parse_ymd('%s-%s-%s' % (year, month, day))
 
+    def assign(self, other):
+        # Takes over the state of other, usually a saved copy of this entry
+        for slot in LogEntry.__slots__:
+            setattr(self, slot, getattr(other, slot))
+
+    def list_media(self):
+        media = glob(join(self._directory, self.mediadir, '*'))
+        return sorted([basename(x) for x in media])
+
+    def refresh_media(self, media=None):
+        self._media = self.list_media() if media is None else media
+
     def reload(self, log_entry, dirty):
         self._dirty = dirty
         self._begin, self._end, self._headers, self._content = LogEntry.try_parse(log_entry)
 
-    def save(self):
-        mdir = join(self._directory, self.mediadir)
+    def save(self, store=None):
+        # media are still in the directory of the date the entry was loaded with
+        mdir = join(self._directory, mediadir(self._filename_date or self._begin, self._index))
         if self._remove:
             if not self._filename:
                 return
+            self.drop_staged_media()
             for media in self._media:
                 print('Removing media %s' % media)
                 remove(join(mdir, media))
@@ -196,50 +291,78 @@ class LogEntry:
             remove(self._filename)
             return
 
+        # Before the file moves or gets truncated, the content may not be loaded
+        text = str(self)
+
+        # A re-dated entry takes its media directory along with a rename
+        moved = None
         if self._filename_date and self._begin != self._filename_date:
-            for media in self._media:
-                victim = join(self._directory, mediadir(self._filename_date, self._index), media)
-                with open(victim, 'rb') as content:
-                    self._added_media.add((media, content.read()))
-                remove(victim)
-            remove(self._filename)
+            moved = self._filename, self._filename_date, self._index, mdir
             self._filename = None
 
         if self._filename is None:
+            # Skip indices whose entry or media directory is taken
             self._index = 0
-            while isfile(join(self._directory, self.fname)):
+            while isfile(join(self._directory, self.fname)) or \
+                  exists(join(self._directory, self.mediadir)):
                 self._index += 1
 
             self.set_filename(join(self._directory, self.fname))
             mdir = join(self._directory, self.mediadir)
 
         print('Saving %s' % self.fname)
-        # ensure the underlying directory is existing
-        makedirs(dirname(self._filename), exist_ok=True)
-        with open(self._filename, 'w') as f:
-            f.write(str(self))
+        try:
+            if moved and isdir(moved[3]):
+                makedirs(dirname(mdir), exist_ok=True)
+                rename(moved[3], mdir)
+
+            # ensure the underlying directory is existing
+            makedirs(dirname(self._filename), exist_ok=True)
+            with open(self._filename, 'w') as f:
+                f.write(text)
+        except OSError:
+            if moved:
+                if isdir(mdir) and not exists(moved[3]):
+                    rename(mdir, moved[3])
+                if isfile(self._filename):
+                    remove(self._filename)
+                self._filename, self._filename_date, self._index, _ = moved
+            raise
+
+        if moved:
+            remove(moved[0])
 
         for media in self._removed_media:
             print('Removing media %s' % media)
             remove(join(mdir, media))
 
-        if len(self._added_media):
+        if len(self._added_media) or len(self._staged_media):
             makedirs(mdir, exist_ok=True)
 
         for name, content in self._added_media:
             filename = join(mdir, name)
-            with open(filename, 'wb') as f:
-                f.write(content)
+            if store:
+                store.put(filename, content=content)
+            else:
+                install(filename, content=content)
 
-        self._added_media = set()
-        self._removed_media = set()
+        for name, staged in self._staged_media:
+            if store:
+                store.put(join(mdir, name), source=staged)
+            else:
+                install(join(mdir, name), source=staged)
+
+        self._added_media = no_changes
+        self._staged_media = no_changes
+        self._removed_media = no_changes
 
     def remove_media(self, no):
         if no >= len(self._media):
             return
 
         victim = self._media.pop(no)
-        self._removed_media.add(victim)
+        self._removed_media = self._removed_media | {victim}
+        self._dirty = True
 
     def remove(self):
         self._dirty = True
@@ -248,12 +371,26 @@ class LogEntry:
     def attach_media(self, name, content):
         # TBD support attachment options
         self._media.append(name)
-        self._added_media.add((name, content))
+        self._added_media = self._added_media | {(name, content)}
+        self._dirty = True
+
+    def attach_media_by_file(self, filename, name=None, staged=False):
+        # Staged files are moved into place on save instead of being read
+        if staged:
+            self._media.append(name or basename(filename))
+            self._staged_media = self._staged_media | {(name or basename(filename), filename)}
+            self._dirty = True
+            return
 
-    def attach_media_by_file(self, filename):
         with open(filename, 'rb') as f:
             content = f.read()
-        return self.attach_media(basename(filename), content)
+        return self.attach_media(name or basename(filename), content)
+
+    def drop_staged_media(self):
+        for _, staged in self._staged_media:
+            if isfile(staged):
+                remove(staged)
+        self._staged_media = no_changes
 
     def __str__(self):
         ret = ''
@@ -262,12 +399,12 @@ class LogEntry:
         ret += 'TOPIC: %s\n' % format_defval(self._headers['TOPIC'])
         ret += 'APPENDIX: %s\n' % format_defval(self._headers['APPENDIX'])
         ret += '\n'
-        ret += self._content
+        ret += self.content
 
         return ret
 
-    def media_url(self, media):
-        return '%s/%s/%s' % (image_url, self.mediadir, media)
+    def media_path(self, media):
+        return join(self.mediadir, media)
 
     def generate_dokuwiki(self):
         return dokuwiki_log_template.render(content=self)
@@ -275,9 +412,8 @@ class LogEntry:
     def to_dokuwiki(self, target_directory):
         target = join(target_directory, 'entry', self.fname)
         makedirs(dirname(target), exist_ok=True)
-
-        with open(target, 'w') as f:
-            f.write(self.generate_dokuwiki())
+        save_filename(self.generate_dokuwiki(), target)
+        return target
 
     @staticmethod
     def sanitise_entry(log_entry):
@@ -287,6 +423,7 @@ class LogEntry:
         return log_entry
 
     @staticmethod
+    @metrics.timed('parse')
     def try_parse(log_entry):
         headers = dict()
         begin = None
@@ -297,15 +434,19 @@ class LogEntry:
 
         log_entry = LogEntry.sanitise_entry(log_entry)
 
-        try:
-            headers_raw, content = log_entry.split('\n\n', 1)
-            headers_raw = headers_raw.split('\n')
-            headers_raw = [x for x in headers_raw if not x.startswith('# ')]
-            headers_raw = [header.split(': ', 1) for header in headers_raw]
-        except Exception as e:
-            raise ValueError('unable to split header and content: %s' % str(e))
-
-        for key, value in headers_raw:
+        # Headers end at the first empty line, the content is left as it is
+        headers_end = log_entry.find('\n\n')
+        if headers_end < 0:
+            raise ValueError('unable to split header and content: %s' % unpack_error)
+        content = log_entry[headers_end + 2:]
+
+        for header in log_entry[0:headers_end].split('\n'):
+            if header.startswith('# '):
+                continue
+            key, separator, value = header.partition(': ')
+            if not separator:
+                raise ValueError(unpack_error)
+
             if key == 'BEGIN':
                 begin = parse_ymd(value)
             elif key == 'END':
@@ -326,14 +467,26 @@ class LogEntry:
         return begin, end, headers, content
 
     @staticmethod
-    def from_file(directory, file):
+    def index_of(file):
+        return int(splitext(basename(file))[0].split('-')[1])
+
+    @staticmethod
+    def mediadir_of(file):
+        path, base = split(file)
+        day, index = splitext(base)[0].split('-')
+        return join('media', path, day, str(int(index)))
+
+    @staticmethod
+    def from_file(directory, file, parsed=None, media=None):
         filename = join(directory, file)
-        with open(filename, 'r') as f:
-            content = f.read()
+        content = None
+        if parsed is None:
+            with open(filename, 'r') as f:
+                content = f.read()
 
-        index = int(file.rstrip('.txt').split('/')[2].split('-')[1])
+        index = LogEntry.index_of(file)
 
-        entry = LogEntry(content, index, directory)
+        entry = LogEntry(content, index, directory, parsed, media)
         entry.set_filename(filename)
 
         return entry
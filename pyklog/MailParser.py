@@ -0,0 +1,205 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import binascii
+import io
+
+from email.message import Message
+from email.parser import BytesHeaderParser
+from os import fdopen, remove
+from tempfile import mkstemp
+
+
+# A part of a parsed mail. Bodies that can't become the text of an entry are
+# decoded to the file staged instead of being kept as payload.
+class MailPart(Message):
+    staged = None
+
+    def take_staged(self):
+        # The caller becomes responsible for removing the file
+        staged, self.staged = self.staged, None
+        return staged
+
+    def drop_staged(self):
+        for part in self.walk():
+            if part.staged:
+                try:
+                    remove(part.staged)
+                except OSError:
+                    pass
+                part.staged = None
+
+
+class Base64Decoder:
+    def __init__(self, f):
+        self._f = f
+        self._rest = b''
+
+    def write(self, data):
+        data = self._rest + b''.join(data.split())
+        cut = len(data) - len(data) % 4
+        self._f.write(binascii.a2b_base64(data[:cut]))
+        self._rest = data[cut:]
+
+    def close(self):
+        if self._rest:
+            try:
+                self._f.write(binascii.a2b_base64(self._rest + b'=' * (-len(self._rest) % 4)))
+            except binascii.Error:
+                pass
+
+
+class QuotedPrintableDecoder:
+    def __init__(self, f):
+        self._f = f
+        self._rest = b''
+
+    def write(self, data):
+        # Escapes and soft line breaks must not be cut apart
+        data = self._rest + data
+        cut = len(data)
+        if not data.endswith(b'\n') and b'=' in data[-2:]:
+            cut = data.rindex(b'=', len(data) - 2)
+        self._f.write(binascii.a2b_qp(data[:cut]))
+        self._rest = data[cut:]
+
+    def close(self):
+        self._f.write(binascii.a2b_qp(self._rest))
+
+
+DECODERS = {'base64': Base64Decoder, 'quoted-printable': QuotedPrintableDecoder}
+
+
+# Splits a mail into its MIME parts while reading it line by line. Lines are
+# read in chunks of at most chunk_size bytes and text/plain parts, which may
+# hold the entry, are the only bodies kept in memory. All others are decoded
+# to files in directory, so the size of attachments doesn't matter. Chunks
+# must be longer than delimiter lines, boundaries have at most 70 characters.
+class MailParser:
+    def __init__(self, directory, chunk_size=1 << 16):
+        self._directory = directory
+        self._chunk_size = chunk_size
+
+    def parse(self, mail):
+        # Accepts raw bytes or a binary file, which is never read as a whole
+        if isinstance(mail, bytes):
+            mail = io.BytesIO(mail)
+
+        self._staged = list()
+        try:
+            message, _ = self._part(self._lines(mail), [])
+        except:
+            # Parts staged so far never make it to the caller
+            for staged in self._staged:
+                remove(staged)
+            raise
+        return message
+
+    def _lines(self, mail):
+        # Yields (line, whether it starts at the beginning of a line)
+        start = True
+        for line in iter(lambda: mail.readline(self._chunk_size), b''):
+            yield line, start
+            start = line.endswith(b'\n')
+
+    @staticmethod
+    def _delimiter(line, start, boundaries):
+        # Returns (boundary, closing) if line delimits one of the boundaries
+        if not start or not line.startswith(b'--'):
+            return None
+        line = line.rstrip()
+        for boundary in reversed(boundaries):
+            if line == b'--' + boundary:
+                return boundary, False
+            if line == b'--' + boundary + b'--':
+                return boundary, True
+        return None
+
+    def _part(self, lines, boundaries):
+        # Returns the part and the delimiter that ended it, None at the end
+        header = list()
+        end = None
+        for line, start in lines:
+            end = self._delimiter(line, start, boundaries)
+            if end:
+                break
+            if start and line in (b'\n', b'\r\n'):
+                break
+            header.append(line)
+        part = BytesHeaderParser(_class=MailPart).parsebytes(b''.join(header))
+        if end:
+            part.set_payload('')
+            return part, end
+
+        boundary = part.get_boundary() if part.get_content_maintype() == 'multipart' else None
+        if boundary:
+            return self._multipart(part, boundary.encode('ascii', 'surrogateescape'), lines, boundaries)
+        return self._body(part, lines, boundaries)
+
+    def _multipart(self, part, boundary, lines, boundaries):
+        inner = boundaries + [boundary]
+        children = list()
+
+        # The preamble ends with the first delimiter
+        end = self._skip(lines, inner)
+        while end and end == (boundary, False):
+            child, end = self._part(lines, inner)
+            children.append(child)
+        if end == (boundary, True):
+            # The epilogue
+            end = self._skip(lines, boundaries)
+
+        part.set_payload(children)
+        return part, end
+
+    def _skip(self, lines, boundaries):
+        for line, start in lines:
+            end = self._delimiter(line, start, boundaries)
+            if end:
+                return end
+        return None
+
+    def _body(self, part, lines, boundaries):
+        keep = part.get_content_type() == 'text/plain'
+        if keep:
+            sink = io.BytesIO()
+            out = sink
+        else:
+            fd, part.staged = mkstemp(dir=self._directory)
+            self._staged.append(part.staged)
+            sink = fdopen(fd, 'wb')
+            encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+            out = DECODERS.get(encoding, lambda x: x)(sink)
+
+        end = None
+        with sink:
+            # The line break in front of a delimiter belongs to the delimiter
+            eol = b''
+            for line, start in lines:
+                end = self._delimiter(line, start, boundaries)
+                if end:
+                    break
+                body = line.rstrip(b'\r\n')
+                out.write(eol + body)
+                eol = line[len(body):]
+            # Without its closing delimiter, the line break in front of the
+            # end of the mail still belongs to the missing delimiter
+            if not end and not boundaries:
+                out.write(eol)
+            if out is not sink:
+                out.close()
+            text = sink.getvalue() if keep else None
+
+        part.set_payload(text.decode('ascii', 'surrogateescape') if keep else '')
+        return part, end
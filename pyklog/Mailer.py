@@ -0,0 +1,118 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import queue
+import smtplib
+import threading
+import time
+
+
+# Delivers replies from a background thread over a single SMTP connection
+# that is kept open until it has been idle for idle_timeout seconds.
+class Mailer:
+    def __init__(self, server, timeout=30, retries=3, retry_delay=2, idle_timeout=30):
+        self._server = server
+        self._timeout = timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._idle_timeout = idle_timeout
+        self._smtp = None
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failures = 0
+
+        self._thread = threading.Thread(target=self._run, name='klog-mailer', daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        self._queue.put(message)
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sent': self._sent,
+                'failures': self._failures,
+                'queued': self._queue.qsize(),
+            }
+
+    def _connect(self):
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._server, timeout=self._timeout)
+        return self._smtp
+
+    def _disconnect(self, graceful=True):
+        if self._smtp is None:
+            return
+        try:
+            if graceful:
+                self._smtp.quit()
+            else:
+                self._smtp.close()
+        except (OSError, smtplib.SMTPException):
+            pass
+        self._smtp = None
+
+    def _run(self):
+        while True:
+            try:
+                message = self._queue.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                continue
+
+            if message is None:
+                self._disconnect()
+                self._queue.task_done()
+                return
+
+            sent = self._deliver(message)
+            with self._lock:
+                if sent:
+                    self._sent += 1
+                else:
+                    self._failures += 1
+            self._queue.task_done()
+
+    def _deliver(self, message):
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(self._retry_delay * 2 ** (attempt - 1))
+
+            try:
+                self._connect().send_message(message)
+                return True
+            except smtplib.SMTPRecipientsRefused as e:
+                print('Reply to %s refused: %s' % (message['To'], str(e)))
+                return False
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500:
+                    print('Reply to %s refused: %s' % (message['To'], str(e)))
+                    return False
+                error = e
+            except (OSError, smtplib.SMTPException) as e:
+                error = e
+
+            print('Failed to send reply to %s: %s' % (message['To'], str(error)))
+            self._disconnect(False)
+
+        return False
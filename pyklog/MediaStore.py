@@ -0,0 +1,144 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import git
+import hashlib
+
+from os import chmod, link, remove, replace
+from os.path import join, isfile, getsize, relpath, samefile, dirname
+from shutil import copyfileobj
+from tempfile import mkstemp
+
+
+def blob_id(content):
+    sha1 = hashlib.sha1(b'blob %d\0' % len(content))
+    sha1.update(content)
+    return sha1.hexdigest()
+
+
+def blob_id_of(filename):
+    sha1 = hashlib.sha1(b'blob %d\0' % getsize(filename))
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def install(filename, content=None, source=None):
+    # Writes content, or moves the file source, to filename. Never writes
+    # through filename, it may be a hard link shared with other media.
+    if source is not None:
+        try:
+            replace(source, filename)
+            # Staged files are private to the process that staged them
+            chmod(filename, 0o644)
+            return
+        except OSError:
+            pass
+
+    fd, tmp = mkstemp(dir=dirname(filename))
+    try:
+        with open(fd, 'wb') as f:
+            if source is None:
+                f.write(content)
+            else:
+                with open(source, 'rb') as s:
+                    copyfileobj(s, f)
+        chmod(tmp, 0o644)
+        replace(tmp, filename)
+    except:
+        remove(tmp)
+        raise
+    if source is not None:
+        remove(source)
+
+
+# Media files of the working tree by their git object id. Git stores a file
+# only once no matter how often it is attached, the store makes sure that
+# repeated uploads don't end up as separate copies in the working tree
+# either: they are hard linked to the file that is already there.
+class MediaStore:
+    def __init__(self, repo):
+        self.repo = repo
+        self._directory = repo.working_dir
+        self._paths = None
+        self._blobs = None
+
+    def _index(self):
+        if self._paths is None:
+            self._paths = dict()
+            self._blobs = dict()
+            try:
+                listing = self.repo.git.ls_files('-s', '-z', '--', 'media')
+            except git.GitCommandError:
+                listing = ''
+            for line in filter(None, listing.split('\0')):
+                meta, path = line.split('\t', 1)
+                self._remember(meta.split(' ')[1], path)
+        return self._paths
+
+    def _remember(self, blob, path):
+        # A path holds a single blob, forget what it held before
+        previous = self._blobs.get(path)
+        if previous and self._paths.get(previous) == path:
+            del self._paths[previous]
+        self._paths[blob] = path
+        self._blobs[path] = blob
+
+    def invalidate(self):
+        # The repository changed, rebuild the index when needed
+        self._paths = None
+        self._blobs = None
+
+    def lookup(self, blob, size):
+        path = self._index().get(blob)
+        if not path:
+            return None
+
+        # The working tree may have changed behind our back, only link to
+        # files that really hold the blob
+        filename = join(self._directory, path)
+        if not isfile(filename) or getsize(filename) != size or blob_id_of(filename) != blob:
+            del self._paths[blob]
+            return None
+        return filename
+
+    def put(self, filename, content=None, source=None):
+        # Writes content, or moves the file source, to filename
+        if source is None:
+            blob, size = blob_id(content), len(content)
+        else:
+            blob, size = blob_id_of(source), getsize(source)
+
+        existing = self.lookup(blob, size)
+        if existing and isfile(filename) and samefile(existing, filename):
+            if source is not None:
+                remove(source)
+            return
+
+        if existing:
+            try:
+                if isfile(filename):
+                    remove(filename)
+                link(existing, filename)
+                self._remember(blob, relpath(filename, self._directory))
+                if source is not None:
+                    remove(source)
+                return
+            except OSError as e:
+                print('Unable to link %s to %s: %s' % (filename, existing, str(e)))
+
+        install(filename, content, source)
+        self._index()
+        self._remember(blob, relpath(filename, self._directory))
@@ -0,0 +1,149 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import functools
+import re
+import threading
+import time
+
+
+class _Timer:
+    __slots__ = ['_metrics', '_name', '_start']
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._metrics.record(self._name, time.perf_counter() - self._start)
+
+
+class _NoTimer:
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_no_timer = _NoTimer()
+
+
+# Timers and counters for the hot paths. Everything is a no-op as long as
+# the metrics are disabled, which is the default.
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._timers = dict()
+        self._counters = dict()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self._timers = dict()
+            self._counters = dict()
+
+    def timer(self, name):
+        if not self.enabled:
+            return _no_timer
+        return _Timer(self, name)
+
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Timer(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, duration):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, duration, duration]
+            else:
+                timer[0] += 1
+                timer[1] += duration
+                timer[2] = max(timer[2], duration)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {name: tuple(x) for name, x in self._timers.items()}, dict(self._counters)
+
+    def report(self):
+        timers, counters = self.snapshot()
+        lines = ['%-24s %8s %10s %10s %10s' % ('phase', 'calls', 'total', 'mean', 'max')]
+        for name, (calls, total, longest) in sorted(timers.items()):
+            lines.append('%-24s %8d %9.3fs %9.3fms %9.3fms' %
+                         (name, calls, total, total / calls * 1000, longest * 1000))
+        if counters:
+            lines.append('')
+            for name, value in sorted(counters.items()):
+                lines.append('%-24s %8d' % (name, value))
+        return '\n'.join(lines)
+
+    def prometheus(self, prefix='klog', counters=None, gauges=None):
+        # Prometheus text exposition format, version 0.0.4. counters and
+        # gauges are added to the collected values, e.g. from other modules.
+        timers, collected = self.snapshot()
+        collected.update(counters or dict())
+        lines = list()
+
+        if timers:
+            lines.append('# HELP %s_phase_seconds Time spent in a phase' % prefix)
+            lines.append('# TYPE %s_phase_seconds summary' % prefix)
+            for name, (calls, total, _) in sorted(timers.items()):
+                lines.append('%s_phase_seconds_sum{phase="%s"} %f' % (prefix, name, total))
+                lines.append('%s_phase_seconds_count{phase="%s"} %d' % (prefix, name, calls))
+            lines.append('# HELP %s_phase_seconds_max Longest run of a phase' % prefix)
+            lines.append('# TYPE %s_phase_seconds_max gauge' % prefix)
+            for name, (_, _, longest) in sorted(timers.items()):
+                lines.append('%s_phase_seconds_max{phase="%s"} %f' % (prefix, name, longest))
+
+        for name, value in sorted(collected.items()):
+            name = '%s_%s_total' % (prefix, metric_name(name))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, value))
+
+        for name, value in sorted((gauges or dict()).items()):
+            name = '%s_%s' % (prefix, metric_name(name))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, 'NaN' if value is None else float(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+metrics = Metrics()
@@ -0,0 +1,106 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import datetime
+import git
+import threading
+import time
+import traceback
+
+
+# Pushes local commits in the background. Commits that pile up while a push
+# is running or failing are published together by the next push.
+class Publisher:
+    def __init__(self, repo, trigger=None, remote='origin', merge_delay=1, retry_delay=10, max_retry_delay=600):
+        self.repo = repo
+        self._trigger = trigger
+        self._remote = remote
+        self._merge_delay = merge_delay
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = list()
+        self._retry = False
+        self._pushes = 0
+        self._failures = 0
+        self._last_push = None
+        self._last_error = None
+
+        self._thread = threading.Thread(target=self._run, name='klog-publisher', daemon=True)
+        self._thread.start()
+
+    def schedule(self, message):
+        with self._lock:
+            self._pending.append((datetime.datetime.now(), message))
+            self._wakeup.notify()
+
+    def retry(self):
+        # Push right away instead of waiting for the retry delay, e.g. after
+        # upstream commits were integrated
+        with self._lock:
+            self._retry = True
+            self._wakeup.notify()
+
+    def status(self):
+        with self._lock:
+            return {
+                'pending': list(self._pending),
+                'pushes': self._pushes,
+                'failures': self._failures,
+                'last_push': self._last_push,
+                'last_error': self._last_error,
+            }
+
+    def _run(self):
+        delay = self._retry_delay
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+
+            # Give bursts of commits the chance to end up in the same push
+            time.sleep(self._merge_delay)
+            with self._lock:
+                published = len(self._pending)
+                self._retry = False
+
+            try:
+                self.repo.git.push(self._remote)
+            except Exception as e:
+                print('Push failed, retrying in %ds: %s' % (delay, str(e)))
+                if not isinstance(e, git.GitCommandError):
+                    traceback.print_exc()
+                with self._lock:
+                    self._failures += 1
+                    self._last_error = datetime.datetime.now(), str(e)
+                    if not self._retry:
+                        self._wakeup.wait(delay)
+                delay = min(delay * 2, self._max_retry_delay)
+                continue
+
+            delay = self._retry_delay
+            with self._lock:
+                del self._pending[0:published]
+                self._pushes += 1
+                self._last_push = datetime.datetime.now()
+                self._last_error = None
+
+            if self._trigger:
+                try:
+                    self._trigger()
+                except Exception as e:
+                    print('Update trigger failed: %s' % str(e))
+                    traceback.print_exc()
@@ -0,0 +1,99 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+
+# Many readers or a single writer. Waiting writers go first, so a steady
+# stream of readers can't starve them. Both sides are reentrant and the
+# owner of the exclusive side may take the shared side as well, but a
+# reader can't become a writer: that would wait for itself forever.
+class RWLock:
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting = 0
+        self._owner = None
+        self._depth = 0
+        # shared locks held by the current thread
+        self._local = threading.local()
+
+    def _held(self):
+        return getattr(self._local, 'held', 0)
+
+    def acquire_shared(self):
+        held = self._held()
+        with self._cond:
+            if self._owner == threading.get_ident():
+                self._depth += 1
+                return
+            # A thread that is reading already must not queue behind writers
+            # waiting for it
+            if not held:
+                while self._owner is not None or self._waiting:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.held = held + 1
+
+    def release_shared(self):
+        with self._cond:
+            if self._owner == threading.get_ident():
+                self._depth -= 1
+                return
+            self._local.held -= 1
+            if self._local.held:
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        me = threading.get_ident()
+        if self._held():
+            raise RuntimeError('Unable to upgrade a shared lock')
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            self._waiting += 1
+            while self._owner is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._owner = me
+            self._depth = 1
+
+    def release_exclusive(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
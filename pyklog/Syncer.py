@@ -0,0 +1,149 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import datetime
+import git
+import threading
+import traceback
+
+from gitdb.exc import BadName
+
+from .Metrics import metrics
+
+
+# Fetches the remote in the background and integrates its commits, so that
+# long running processes see what was pushed from other clones and their own
+# pushes don't run into non-fast-forward errors. Fetching doesn't need any
+# lock, only integrating waits for the log's writer lock. integrated, if
+# given, is called after upstream commits were integrated, e.g. to retry a
+# push that was rejected before.
+class Syncer:
+    def __init__(self, klog, remote='origin', interval=300, integrated=None):
+        self.klog = klog
+        self.repo = klog.repo
+        self._remote = remote
+        self._interval = interval
+        self._integrated = integrated
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._scheduled = False
+        self._fetches = 0
+        self._failures = 0
+        self._fast_forwards = 0
+        self._merges = 0
+        self._last_sync = None
+        self._last_error = None
+        self._conflict = None
+
+        if interval > 0:
+            self._thread = threading.Thread(target=self._run, name='klog-syncer', daemon=True)
+            self._thread.start()
+
+    def schedule(self):
+        # Sync now instead of waiting for the interval to pass
+        with self._lock:
+            self._scheduled = True
+            self._wakeup.notify()
+
+    def status(self):
+        with self._lock:
+            return {
+                'interval': self._interval,
+                'fetches': self._fetches,
+                'failures': self._failures,
+                'fast_forwards': self._fast_forwards,
+                'merges': self._merges,
+                'last_sync': self._last_sync,
+                'last_error': self._last_error,
+                'conflict': self._conflict,
+            }
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._scheduled:
+                    self._wakeup.wait(self._interval)
+                self._scheduled = False
+
+            # Whatever goes wrong, keep syncing
+            try:
+                self.sync()
+            except Exception as e:
+                print('Sync failed: %s' % str(e))
+                traceback.print_exc()
+                with self._lock:
+                    self._failures += 1
+                    self._last_error = datetime.datetime.now(), str(e)
+
+    def sync(self):
+        # Returns whether upstream commits were integrated
+        try:
+            with metrics.timer('sync.fetch'):
+                self.repo.git.fetch(self._remote)
+            with self._lock:
+                self._fetches += 1
+
+            with self.klog.writing():
+                result = self._integrate()
+        except (git.GitCommandError, BadName, TypeError) as e:
+            # BadName: no such upstream branch, TypeError: detached HEAD
+            print('Sync failed: %s' % str(e))
+            with self._lock:
+                self._failures += 1
+                self._last_error = datetime.datetime.now(), str(e)
+            return False
+
+        with self._lock:
+            self._last_sync = datetime.datetime.now()
+            self._last_error = None
+            if result == 'conflict':
+                return False
+            self._conflict = None
+            if result == 'fast-forward':
+                self._fast_forwards += 1
+            elif result == 'merge':
+                self._merges += 1
+
+        if result and self._integrated:
+            self._integrated()
+        return result is not None
+
+    def _integrate(self):
+        upstream = '%s/%s' % (self._remote, self.repo.active_branch.name)
+        ours = self.repo.head.commit
+        theirs = self.repo.commit(upstream)
+        if ours == theirs or self.repo.is_ancestor(theirs, ours):
+            return None
+
+        if self.repo.is_ancestor(ours, theirs):
+            with metrics.timer('sync.merge'):
+                self.repo.git.merge('--ff-only', upstream)
+            result = 'fast-forward'
+        else:
+            # Both sides have new commits. Entries live in files of their
+            # own, so a plain merge rarely conflicts.
+            try:
+                with metrics.timer('sync.merge'):
+                    self.repo.git.merge('--no-edit', upstream)
+            except git.GitCommandError as e:
+                self.repo.git.merge('--abort')
+                print('Unable to merge %s: %s' % (upstream, str(e)))
+                with self._lock:
+                    self._conflict = datetime.datetime.now(), upstream, str(e)
+                return 'conflict'
+            result = 'merge'
+
+        self.klog.refresh()
+        return result
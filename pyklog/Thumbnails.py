@@ -0,0 +1,114 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import hashlib
+import threading
+
+from os import makedirs, replace, stat, remove
+from os.path import join, isfile
+from tempfile import mkstemp
+
+try:
+    from PIL import Image, ImageOps
+    has_pil = True
+except ImportError:
+    has_pil = False
+
+
+# Resized versions of media files. Derivatives are named after the SHA-1 of
+# the original's content, so renamed or re-dated media and identical uploads
+# share them and a changed file never hits a stale one.
+class Thumbnails:
+    SIZES = {
+        'thumb': 400,
+        'web': 1600,
+    }
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        # (path, mtime, size) -> content digest, saves rehashing the originals
+        self._digests = dict()
+        # digests of originals that PIL failed on, those are served as they are
+        self._unscalable = set()
+        makedirs(directory, exist_ok=True)
+
+    def _digest(self, source):
+        st = stat(source)
+        key = source, st.st_mtime_ns, st.st_size
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest:
+            return digest
+
+        sha1 = hashlib.sha1()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+
+        with self._lock:
+            self._digests[key] = digest
+        return digest
+
+    def get(self, source, size):
+        # Returns the file to deliver for source. That's the original if it
+        # can't be scaled or is small enough already.
+        if not has_pil or size not in self.SIZES:
+            return source
+
+        digest = self._digest(source)
+        if digest in self._unscalable:
+            return source
+
+        for ext in ['jpg', 'png']:
+            derivative = join(self._directory, digest[0:2], '%s-%s.%s' % (digest, size, ext))
+            if isfile(derivative):
+                return derivative
+
+        try:
+            return self._generate(source, digest, size) or source
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print('Unable to scale %s: %s' % (source, str(e)))
+            with self._lock:
+                self._unscalable.add(digest)
+            return source
+
+    def _generate(self, source, digest, size):
+        limit = self.SIZES[size]
+        with Image.open(source) as image:
+            if max(image.size) <= limit and image.format in ['JPEG', 'PNG']:
+                return None
+
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((limit, limit))
+            if image.mode in ['RGBA', 'LA', 'P']:
+                ext, format = 'png', 'PNG'
+            else:
+                ext, format = 'jpg', 'JPEG'
+                image = image.convert('RGB')
+
+            directory = join(self._directory, digest[0:2])
+            makedirs(directory, exist_ok=True)
+            fd, tmp = mkstemp(dir=directory)
+            try:
+                with open(fd, 'wb') as f:
+                    image.save(f, format, optimize=True)
+                derivative = join(directory, '%s-%s.%s' % (digest, size, ext))
+                replace(tmp, derivative)
+            except:
+                remove(tmp)
+                raise
+
+        return derivative
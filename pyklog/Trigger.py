@@ -0,0 +1,119 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import threading
+import time
+import urllib.request
+
+
+# Calls the wiki's update URL in the background. All fire()s that arrive
+# within the debounce window of the first one end up in a single call.
+class UpdateTrigger:
+    def __init__(self, url, timeout=10, retries=3, backoff=1, debounce=2):
+        self._url = url
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._debounce = debounce
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._deadline = None
+        self._busy = False
+
+        self._calls = 0
+        self._requests = 0
+        self._retried = 0
+        self._failures = 0
+        self._latency = 0.0
+        self._last_latency = None
+        self._last_error = None
+
+        self._thread = threading.Thread(target=self._run, name='klog-trigger', daemon=True)
+        self._thread.start()
+
+    def fire(self):
+        with self._lock:
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self._debounce
+                self._wakeup.notify_all()
+
+    def flush(self, timeout=None):
+        # Wait for pending calls, e.g. before a short-lived process exits
+        with self._lock:
+            if self._deadline is not None:
+                self._deadline = time.monotonic()
+                self._wakeup.notify_all()
+            return self._wakeup.wait_for(lambda: self._deadline is None and not self._busy, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'requests': self._requests,
+                'retries': self._retried,
+                'failures': self._failures,
+                'latency': self._latency,
+                'last_latency': self._last_latency,
+                'last_error': self._last_error,
+            }
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._deadline is None or self._deadline > time.monotonic():
+                    if self._deadline is None:
+                        self._wakeup.wait()
+                    else:
+                        self._wakeup.wait(self._deadline - time.monotonic())
+                self._deadline = None
+                self._busy = True
+
+            self._call()
+
+            with self._lock:
+                self._busy = False
+                self._wakeup.notify_all()
+
+    def _call(self):
+        with self._lock:
+            self._calls += 1
+
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+                with self._lock:
+                    self._retried += 1
+
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen(self._url, timeout=self._timeout) as response:
+                    response.read()
+                error = None
+            except Exception as e:
+                error = str(e)
+            latency = time.monotonic() - start
+
+            with self._lock:
+                self._requests += 1
+                self._latency += latency
+                self._last_latency = latency
+                if not error:
+                    return
+
+            print('Update trigger error: %s' % error)
+
+        with self._lock:
+            self._failures += 1
+            self._last_error = error
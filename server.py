@@ -17,30 +17,136 @@ FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 details.
 """
 
+import functools
+import git
+import hashlib
+import mimetypes
 import os
+import threading
+import time
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from flask_wtf import FlaskForm
 from wtforms import StringField
 from wtforms.validators import DataRequired
 
-from pyklog.LogEntry import LogEntry
+from pyklog.LogEntry import LogEntry, parse_ymd
 from pyklog.KitchenLog import Config, KitchenLog
+from pyklog.Metrics import metrics
+from pyklog.Publisher import Publisher
+from pyklog.Syncer import Syncer
+from pyklog.Thumbnails import Thumbnails
 from locale import setlocale, LC_ALL
 
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, jsonify, send_file, abort, g, make_response
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
+try:
+    from waitress import serve
+    has_waitress = True
+except ImportError:
+    has_waitress = False
+
 setlocale(LC_ALL, 'de_DE.UTF-8')
 
 f_config = os.path.join(os.environ['HOME'], '.config', 'klogrc')
+metrics.enable()
 cfg = Config(f_config, needs_email=False, sync=True)
 
-klog = KitchenLog(cfg.repo)
+klog = KitchenLog(cfg.repo, cfg.d_cache)
+publisher = Publisher(cfg.repo, cfg.update_trigger)
+syncer = Syncer(klog, interval=cfg.sync_interval if cfg.sync else 0, integrated=publisher.retry)
+thumbnails = Thumbnails(os.path.join(cfg.d_cache, 'thumbnails'))
 app = Flask('klog')
 
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'bmp', 'svg', 'eps', 'tiff'])
+# Media the browser may display, everything else (e.g. SVG, which can carry
+# scripts) is only offered for download
+INLINE_MEDIA = set(['image/png', 'image/jpeg', 'image/gif', 'image/bmp', 'image/webp'])
+PAGE_CACHE_SIZE = 256
+# Years rendered right away by /list, older ones are loaded on demand
+LIST_YEARS = 2
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+SERVER_THREADS = 8
+
+
+# Rendered pages by HEAD, state of the log and URL. Pages only change with
+# the log, which bumps its generation, so nothing needs to be invalidated
+# explicitly.
+class PageCache:
+    def __init__(self, size):
+        self._size = size
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._head = None
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page):
+        with self._lock:
+            # Pages of older HEADs will never be requested again
+            if key[0] != self._head:
+                self._pages.clear()
+                self._head = key[0]
+            self._pages[key] = page
+            while len(self._pages) > self._size:
+                self._pages.popitem(last=False)
+
+
+pages = PageCache(PAGE_CACHE_SIZE)
+
+
+def cached(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+
+        key = klog.head, klog.generation, request.full_path
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()
+        if etag in request.if_none_match:
+            # make_conditional() turns this into a 304
+            metrics.count('page_cache_not_modified')
+            page = ''
+        else:
+            page = pages.get(key)
+            if page is None:
+                metrics.count('page_cache_misses')
+                page = view(*args, **kwargs)
+                # Responses are mutable and may depend on the request,
+                # only rendered pages are shared
+                if not isinstance(page, str):
+                    return page
+                pages.put(key, page)
+            else:
+                metrics.count('page_cache_hits')
+
+        response = make_response(page)
+        response.set_etag(etag)
+        response.last_modified = klog.head_date
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return wrapper
+
+
+def synchronised(view):
+    # Views may run concurrently: GET requests only read the log, everything
+    # else is serialised against other writers
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        lock = klog.reading() if request.method == 'GET' else klog.writing()
+        with lock:
+            return view(*args, **kwargs)
+    return wrapper
 
 class EntryForm(FlaskForm):
     begin = StringField('begin', validators=[DataRequired()])
@@ -77,6 +183,56 @@ APPENDIX: %s
         return LogEntry.sanitise_entry(entry_raw)
 
 
+def entry_json(entry):
+    return {
+        'id': entry.key,
+        'begin': entry.begin_ymd,
+        'end': entry.end_ymd if entry.end else None,
+        'topic': entry.topic,
+        'appendix': entry.appendix,
+        'content': entry.content,
+        'media': entry.media,
+        'media_urls': ['/' + entry.media_path(x) for x in entry.media],
+    }
+
+
+def entry_etag(entry):
+    # The JSON only depends on the entry's file and the names of its media,
+    # which are known without loading the content for committed entries
+    blob = klog.version(entry)
+    return hashlib.sha1('\0'.join([blob] + entry.media).encode()).hexdigest()
+
+
+def json_response(etag, build):
+    # build is only called if the client doesn't have the current version
+    if etag in request.if_none_match:
+        metrics.count('api_not_modified')
+        response = make_response('', 304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.before_request
+def refresh():
+    # klog, klogd or other server processes may have committed meanwhile
+    klog.refresh()
+
+
+@app.after_request
+def stop_timer(response):
+    if 'start' in g and request.endpoint:
+        metrics.record('request.%s' % request.endpoint, time.perf_counter() - g.start)
+    return response
+
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -85,6 +241,16 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def publish(message):
+    try:
+        klog.commit(message, no_sync=True)
+    except (git.GitCommandError, OSError) as e:
+        # Don't let the next commit pick up the changes of this request
+        klog.revert()
+        raise ValueError('Unable to commit: %s' % str(e))
+    publisher.schedule(message)
+
+
 def attach_media(entry, media_list):
     for f in media_list:
         entry.attach_media(secure_filename(f.filename), f.read())
@@ -99,21 +265,29 @@ def new_media(request):
     return image_list
 
 @app.route('/modify', methods=['POST', 'GET'])
+@cached
+@synchronised
 def modify():
     id = request.args.get('id')
     info = None
 
     if id is None:
-        return list()
+        return render_list()
 
-    try:
-        id = int(id)
-    except ValueError:
-        return list()
-
-    entry = klog.get_no(id)
+    entry = klog.get_key(id)
     if not entry:
-        return list()
+        info = 'Unknown or outdated entry %s, please choose again' % id, 'danger'
+        return render_list(info)
+
+    # GET requests only hold the shared lock and must not edit, even if
+    # they come with a form
+    if request.method != 'POST':
+        return render_template('modify.html', id=id, entry=entry, version=klog.version(entry), info=info)
+
+    # Keys of deleted entries are reused, the form must belong to this one
+    if request.form.get('version') != klog.version(entry):
+        info = 'Entry %s changed since you opened it, please check it and try again' % id, 'danger'
+        return render_template('modify.html', id=id, entry=entry, version=klog.version(entry), info=info)
 
     removals = [x.replace('remove_', '') for x in request.form.keys() if x.startswith('remove_')]
     try:
@@ -126,56 +300,220 @@ def modify():
     if entry_form.validate():
         try:
             entry_raw = entry_form.convert()
-            entry.reload(entry_raw, True)
+            entry_old = str(entry)
+            with klog.editing():
+                entry.reload(entry_raw, True)
             image_list = new_media(request)
-            if entry_raw == str(entry) and len(removals) == 0 and not image_list:
-                info = 'Nothing changed', 'warning'
-            elif 'remove' in request.form:
-                entry.remove()
-                klog.commit('Removed %s' % entry.shortlog)
-                cfg.update_trigger()
+            if 'remove' in request.form:
+                with klog.editing():
+                    entry.remove()
+                publish('Removed %s' % entry.shortlog)
                 info = 'Entry successfully removed', 'success'
-                return render_template('list.html', info=info, content=klog.years_dict())
+                return render_list(info)
+            elif entry_raw == entry_old and len(removals) == 0 and not image_list:
+                # Reloading left the entry dirty, discarding replaces it
+                klog.discard()
+                entry = klog.get_key(id) or entry
+                info = 'Nothing changed', 'warning'
             else:
-                for removal in removals:
-                    entry.remove_media(removal)
-                if image_list:
-                    attach_media(entry, image_list)
+                with klog.editing():
+                    for removal in removals:
+                        entry.remove_media(removal)
+                    if image_list:
+                        attach_media(entry, image_list)
                 info = 'success', 'success'
-                klog.commit('Modified %s ' % entry.shortlog)
-                cfg.update_trigger()
+                publish('Modified %s ' % entry.shortlog)
+                # the entry may have moved on disk
+                id = entry.key
+                entry = klog.get_key(id) or entry
         except ValueError as e:
+            klog.discard()
             info = str(e), 'danger'
-    return render_template('modify.html', id=id, entry=entry, info=info)
+    return render_template('modify.html', id=id, entry=entry, version=klog.version(entry), info=info)
+
+
+def render_list(info=None, year=None):
+    years = klog.years()
+    shown = {year} if year else {x for x, _ in years[:LIST_YEARS]}
+    content = [(x, klog.year(x) if x in shown else None, count) for x, count in years]
+    return render_template('list.html', info=info, content=content)
 
 
 @app.route('/list')
+@cached
+@synchronised
 def list():
-    return render_template('list.html', content=klog.years_dict())
+    return render_list()
+
+
+@app.route('/list/<int:year>')
+@cached
+@synchronised
+def list_year(year):
+    months = klog.year(year)
+    if not months:
+        abort(404)
+
+    # Fragments are requested by the list page, everyone else gets a page
+    if 'fragment' in request.args:
+        return render_template('list_year.html', months=months)
+    return render_list(year=year)
+
+
+@app.route('/status')
+def status():
+    return render_template('status.html', publisher=publisher.status(), syncer=syncer.status(),
+                           trigger=cfg.trigger.stats())
+
+
+@app.route('/metrics')
+def prometheus():
+    status = publisher.status()
+    sync = syncer.status()
+    trigger = cfg.trigger.stats()
+    counters = {
+        'pushes': status['pushes'],
+        'push_failures': status['failures'],
+        'fetches': sync['fetches'],
+        'fetch_failures': sync['failures'],
+        'fast_forwards': sync['fast_forwards'],
+        'merges': sync['merges'],
+        'trigger_calls': trigger['calls'],
+        'trigger_requests': trigger['requests'],
+        'trigger_failures': trigger['failures'],
+    }
+    gauges = {
+        'entries': len(klog),
+        'pending_pushes': len(status['pending']),
+        'sync_conflict': 1 if sync['conflict'] else 0,
+        'trigger_last_latency_seconds': trigger['last_latency'],
+    }
+    return metrics.prometheus(counters=counters, gauges=gauges), 200, \
+           {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/search')
+@synchronised
+def search():
+    query = request.args.get('q', '')
+    return render_template('search.html', query=query, entries=klog.search(query))
+
+
+def api_int(args, name, default=None):
+    try:
+        return int(args[name]) if name in args else default
+    except ValueError:
+        raise ValueError('Invalid %s: %s' % (name, args[name]))
+
+
+def api_range(args):
+    # Returns the dates to filter for, raises ValueError on invalid arguments
+    if 'year' in args:
+        year = api_int(args, 'year')
+        month = api_int(args, 'month')
+        if month is not None:
+            begin = datetime(year, month, 1)
+            end = datetime(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        else:
+            begin, end = datetime(year, 1, 1), datetime(year, 12, 31)
+        return begin, end
+
+    if 'month' in args:
+        raise ValueError('month requires year')
+
+    begin = end = None
+    if 'begin' in args:
+        begin = parse_ymd(args['begin'])
+        if not begin:
+            raise ValueError('Invalid begin date: %s' % args['begin'])
+        end = begin
+    if 'end' in args:
+        end = parse_ymd(args['end'])
+        if not end:
+            raise ValueError('Invalid end date: %s' % args['end'])
+    return begin, end
+
+
+@app.route('/api/entries')
+@synchronised
+def api_entries():
+    # Newest entries first. Filter by year and month or by begin and end
+    # date, continue with the returned cursor to get the next page.
+    try:
+        begin, end = api_range(request.args)
+        limit = api_int(request.args, 'limit', API_PAGE_SIZE)
+        if not 0 < limit <= API_MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and %d' % API_MAX_PAGE_SIZE)
+        entries, more = klog.page(begin, end, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    cursor = entries[-1].key if more else None
+    etags = [entry_etag(x) for x in entries]
+    etag = hashlib.sha1(repr((request.full_path, cursor, etags)).encode()).hexdigest()
+    return json_response(etag, lambda: {
+        'entries': [entry_json(x) for x in entries],
+        'cursor': cursor,
+    })
+
+
+@app.route('/api/entries/<key>')
+@synchronised
+def api_entry(key):
+    entry = klog.get_key(key)
+    if not entry:
+        return jsonify(error='Unknown or outdated entry %s' % key), 404
+
+    return json_response(entry_etag(entry), lambda: entry_json(entry))
+
+
+@app.route('/media/<path:name>')
+def media(name):
+    source = safe_join(cfg.d_repo, 'media', name)
+    if not source or not os.path.isfile(source):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(source)[0]
+    if mimetype in INLINE_MEDIA:
+        response = send_file(thumbnails.get(source, request.args.get('size')))
+    else:
+        response = send_file(source, mimetype='application/octet-stream', as_attachment=True)
+    response.headers['Content-Security-Policy'] = 'sandbox'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 
 @app.route('/new', methods=['POST', 'GET'])
+@synchronised
 def new():
-    entry_form = EntryForm(request.form, csrf_enabled=False)
     info = None
 
-    if entry_form.validate():
+    # GET requests only hold the shared lock and must not edit
+    entry_form = EntryForm(request.form, csrf_enabled=False) if request.method == 'POST' else None
+    if entry_form is not None and entry_form.validate():
         entry = klog.new_entry(datetime.today())
         entry_raw = entry_form.convert()
         try:
-            entry.reload(entry_raw, True)
-            image_list = new_media(request)
-            if image_list:
-                attach_media(entry, image_list)
+            with klog.editing():
+                entry.reload(entry_raw, True)
+                image_list = new_media(request)
+                if image_list:
+                    attach_media(entry, image_list)
             info = 'success', 'success'
-            klog.commit('Modified %s ' % entry.shortlog)
-            cfg.update_trigger()
-            return render_template('list.html', info=info, content=klog.years_dict())
+            publish('Modified %s ' % entry.shortlog)
+            return render_list(info)
         except ValueError as e:
+            # Don't leave the half-baked entry behind
+            klog.discard()
             info = str(e), 'danger'
 
     template = LogEntry.new(cfg.d_repo, datetime.today())
     return render_template('new.html', info=info, template=template)
 
 
-app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
+if __name__ == '__main__':
+    if has_waitress:
+        serve(app, host='0.0.0.0', port=8080, threads=SERVER_THREADS)
+    else:
+        print('waitress not found, falling back to the development server')
+        app.run(host='0.0.0.0', port=8080, threaded=True)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+"""
+klog-bench - Benchmarks for klog on synthetic kitchenlogs
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import argparse
+import datetime
+import email
+import git
+import glob
+import importlib.util
+import json
+import locale
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+base = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, base)
+
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from pyklog.KitchenLog import KitchenLog, mail_end_marker
+from pyklog.LogEntry import LogEntry
+
+lorem = 'Lorem ipsum dolor sit amet consetetur sadipscing elitr sed diam nonumy ' \
+        'eirmod tempor invidunt ut labore et dolore magna aliquyam erat'.split(' ')
+
+entry_template = \
+"""BEGIN: %s
+END: %s
+TOPIC: %s
+APPENDIX: None
+
+%s
+"""
+
+
+def random_text(rnd, words):
+    lines = list()
+    while words > 0:
+        length = min(words, rnd.randint(4, 12))
+        lines.append('  * ' + ' '.join(rnd.choice(lorem) for _ in range(length)))
+        words -= length
+    return '\n'.join(lines)
+
+
+def generate(directory, entries, words, media, media_size, years, seed=0):
+    rnd = random.Random(seed)
+    repo = git.Repo.init(directory)
+    first = datetime.date.today() - datetime.timedelta(days=365 * years)
+
+    for no in range(entries):
+        begin = first + datetime.timedelta(days=rnd.randrange(365 * years))
+        end = None
+        if rnd.random() < 0.1:
+            end = begin + datetime.timedelta(days=rnd.randint(1, 5))
+
+        day = os.path.join(directory, begin.strftime('%Y/%m'))
+        os.makedirs(day, exist_ok=True)
+        index = 0
+        while os.path.isfile(os.path.join(day, '%s-%d.txt' % (begin.strftime('%d'), index))):
+            index += 1
+
+        with open(os.path.join(day, '%s-%d.txt' % (begin.strftime('%d'), index)), 'w') as f:
+            f.write(entry_template % (begin.strftime('%Y-%m-%d'),
+                                      end.strftime('%Y-%m-%d') if end else 'None',
+                                      'Topic %d' % no,
+                                      random_text(rnd, words)))
+
+        for medium in range(rnd.randint(0, media)):
+            mdir = os.path.join(directory, 'media', begin.strftime('%Y/%m/%d'), str(index))
+            os.makedirs(mdir, exist_ok=True)
+            with open(os.path.join(mdir, 'image%d.jpg' % medium), 'wb') as f:
+                f.write(os.urandom(media_size))
+
+    with repo.config_writer() as config:
+        config.set_value('user', 'name', 'klog bench')
+        config.set_value('user', 'email', 'klog@localhost')
+    repo.git.add('-A')
+    repo.git.commit('-m', 'Synthetic kitchenlog')
+    return repo
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    ret = function(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+
+# Collects the numbers of a benchmark. Timings are repeated and summarised,
+# other values are recorded as they are.
+class Results:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.values = dict()
+
+    def time(self, name, function, repeat=None, setup=None):
+        # setup isn't timed, its result is passed to function
+        runs = list()
+        for _ in range(repeat or self.repeat):
+            if setup:
+                duration, ret = timed(function, setup())
+            else:
+                duration, ret = timed(function)
+            runs.append(duration)
+        self.values[name] = {
+            'unit': 's',
+            'min': min(runs),
+            'median': statistics.median(runs),
+            'mean': statistics.mean(runs),
+            'runs': runs,
+        }
+        return ret
+
+    def record(self, name, value, unit):
+        self.values[name] = {'unit': unit, 'value': value}
+
+    def print(self):
+        for name, value in self.values.items():
+            if value['unit'] == 's':
+                print('%-28s %10.3fms (median %.3fms, %d runs)' %
+                      (name, value['min'] * 1000, value['median'] * 1000, len(value['runs'])))
+            elif value['unit'] == 'B':
+                print('%-28s %10.1fMiB' % (name, value['value'] / 2**20))
+            else:
+                print('%-28s %10s %s' % (name, value['value'], value['unit']))
+
+
+def text_mail(subject, body):
+    mail = MIMEText(body)
+    mail['From'] = 'Bench <bench@localhost>'
+    mail['Subject'] = subject
+    return mail.as_bytes()
+
+
+def bench_core(args, repo, workdir, results):
+    klog = results.time('load', lambda: KitchenLog(repo))
+    results.time('reload, full', lambda: klog._reload())
+
+    changes = random.Random(2)
+
+    def change_entries():
+        # Commits changes to some entries behind the log's back, the
+        # incremental reload has to pick them up from the diff
+        previous = klog._head
+        entries = changes.sample(klog._entries, min(args.changes, len(klog)))
+        for entry in entries:
+            with open(os.path.join(repo.working_dir, entry.path), 'a') as f:
+                f.write('  * changed\n')
+        repo.git.add('-A')
+        repo.git.commit('-m', 'Changed %d entries' % len(entries))
+        return previous
+    results.time('reload, incremental', lambda previous: klog._reload(previous), setup=change_entries)
+    results.time('years_dict', klog.years_dict)
+    results.time('export, full', lambda: klog._export_dokuwiki())
+    repo.git.add('-A')
+    repo.git.commit('-m', 'Export')
+
+    rnd = random.Random(1)
+
+    def commit():
+        entry = rnd.choice(klog._entries)
+        entry.reload(str(entry) + '  * modified\n', True)
+        klog.commit('Modified %s' % entry.shortlog, no_sync=True)
+    results.time('commit, one entry', commit)
+
+    entry = klog._entries[0]
+    new = text_mail('new %s' % entry.begin_ymd,
+                    entry_template % (entry.begin_ymd, 'None', 'Mail', random_text(rnd, args.words)) +
+                    '\n' + mail_end_marker + '\n')
+    search = text_mail('search %s' % ' '.join(lorem[0:2]), '')
+
+    def handle(mail):
+        klog.handle_email('klog@localhost', mail)
+        klog.discard()
+    results.time('handle_email, new', lambda: handle(new))
+    results.time('handle_email, search', lambda: handle(search))
+    results.time('handle_email, list', lambda: handle(text_mail('list', '')))
+
+
+def legacy_parse(log_entry):
+    # try_parse as it was before the single-pass parser, for comparison
+    def parse_ymd(value):
+        if value.lower() == 'none' or not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return None
+
+    headers = dict()
+    begin = None
+    end = None
+
+    if not log_entry:
+        raise ValueError('file is empty')
+
+    log_entry = log_entry.replace('\r', '')
+    log_entry = '\n'.join([x.rstrip() for x in log_entry.split('\n')])
+    log_entry = log_entry.rstrip() + '\n'
+
+    try:
+        headers_raw, content = log_entry.split('\n\n', 1)
+        headers_raw = headers_raw.split('\n')
+        headers_raw = [x for x in headers_raw if not x.startswith('# ')]
+        headers_raw = [header.split(': ', 1) for header in headers_raw]
+    except Exception as e:
+        raise ValueError('unable to split header and content: %s' % str(e))
+
+    for key, value in headers_raw:
+        if key == 'BEGIN':
+            begin = parse_ymd(value)
+        elif key == 'END':
+            end = parse_ymd(value)
+        else:
+            headers[key] = None if value.lower() == 'none' or not value else value
+
+    if begin is None:
+        raise ValueError('Missing header: BEGIN')
+    if 'TOPIC' not in headers:
+        raise ValueError('Missing header: TOPIC')
+    if 'APPENDIX' not in headers:
+        raise ValueError('Missing header: APPENDIX')
+    if not content:
+        raise ValueError('Empty content')
+
+    return begin, end, headers, content
+
+
+def outcome(parse, log_entry):
+    try:
+        return parse(log_entry)
+    except ValueError as e:
+        return 'ValueError: %s' % str(e)
+
+
+def mutations(rnd, log_entry):
+    # Broken and unusual variants of an entry, both parsers must agree on them
+    lines = log_entry.split('\n')
+    yield log_entry.replace('\n', '\r\n')
+    yield '\n'.join(x + rnd.choice([' ', '\t', ' \x0b', '\u2028 ']) for x in lines)
+    yield '\n'.join(lines[0:2] + ['# comment', 'BROKEN'] + lines[2:])
+    yield '\n'.join(lines[0:4])
+    yield log_entry.replace('BEGIN: ', 'BEGIN: 2018-2-30', 1)
+    yield log_entry.replace('BEGIN: 20', 'BEGIN:  20', 1)
+    yield log_entry.replace('TOPIC', '# TOPIC', 1)
+    yield log_entry.replace('\n\n', '\n   \n\n', 1)
+    yield '\n' + log_entry
+    yield ''
+
+
+def bench_parse(args, repo, workdir, results):
+    corpus = list()
+    for path in sorted(glob.glob(os.path.join(repo.working_dir, KitchenLog.FILES_GLOB))):
+        with open(path) as f:
+            corpus.append(f.read())
+
+    rnd = random.Random(3)
+    checks = corpus + [x for entry in corpus[0:200] for x in mutations(rnd, entry)]
+    for log_entry in checks:
+        if outcome(legacy_parse, log_entry) != outcome(LogEntry.try_parse, log_entry):
+            raise RuntimeError('Parsers disagree on:\n%s' % log_entry)
+    results.record('checked entries', len(checks), '')
+
+    results.time('legacy parser', lambda: [legacy_parse(x) for x in corpus])
+    results.time('try_parse', lambda: [LogEntry.try_parse(x) for x in corpus])
+
+
+def bench_cache(args, repo, workdir, results):
+    cache = os.path.join(workdir, 'cache')
+    os.makedirs(cache, exist_ok=True)
+
+    results.time('no cache', lambda: KitchenLog(repo))
+    results.time('cache, empty', lambda: KitchenLog(repo, cache), repeat=1)
+    results.time('cache, populated', lambda: KitchenLog(repo, cache))
+
+
+def peak_memory(function, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args, repo, workdir, results):
+    cache = os.path.join(workdir, 'cache')
+    os.makedirs(cache, exist_ok=True)
+    KitchenLog(repo, cache)
+
+    for name, cache in [('no cache', None), ('cache', cache)]:
+        tracemalloc.start()
+        klog = KitchenLog(repo, cache)
+        resident = tracemalloc.get_traced_memory()[0]
+        for entry in klog._entries:
+            entry.content
+        loaded = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results.record('%s, per entry' % name, resident // len(klog), 'B/entry')
+        results.record('%s, contents loaded' % name, loaded // len(klog), 'B/entry')
+        del klog
+
+
+def bench_mail(args, repo, workdir, results):
+    mail = MIMEMultipart()
+    mail['From'] = 'Bench <bench@localhost>'
+    mail['Subject'] = 'new'
+    mail.attach(MIMEText(entry_template % ('2018-01-01', 'None', 'Mail', 'Attachments') +
+                         '\n' + mail_end_marker + '\n'))
+    for no in range(args.attachments):
+        image = MIMEImage(os.urandom(args.attachment_size), 'jpeg')
+        image.add_header('Content-Disposition', 'attachment', filename='image%d.jpg' % no)
+        mail.attach(image)
+
+    filename = os.path.join(workdir, 'mail.eml')
+    with open(filename, 'wb') as f:
+        f.write(mail.as_bytes())
+    del mail
+
+    klog = KitchenLog(repo)
+
+    def legacy():
+        with open(filename, 'rb') as f:
+            message = email.message_from_bytes(f.read())
+        return [x.get_payload(decode=True) for x in message.walk() if x.get_content_maintype() == 'image']
+
+    def streaming():
+        with open(filename, 'rb') as f:
+            klog.handle_email('klog@localhost', f)
+        klog.discard()
+
+    results.record('mail size', os.path.getsize(filename), 'B')
+    results.record('legacy peak', peak_memory(legacy), 'B')
+    results.record('streaming peak', peak_memory(streaming), 'B')
+
+
+def bench_web(args, repo, workdir, results):
+    # The server configures itself from ~/.config/klogrc on import
+    home = os.path.join(workdir, 'home')
+    os.makedirs(os.path.join(home, '.config'), exist_ok=True)
+    with open(os.path.join(home, '.config', 'klogrc'), 'w') as f:
+        f.write('[klog]\n'
+                'cache = %s\n'
+                'kitchenlog = %s\n'
+                'update_trigger = http://127.0.0.1:9/\n' % (os.path.join(workdir, 'web'), repo.working_dir))
+    os.environ['HOME'] = home
+
+    spec = importlib.util.spec_from_file_location('server', os.path.join(base, 'server.py'))
+    server = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(server)
+    except locale.Error as e:
+        print('Skipping web benchmark: %s' % str(e))
+        return
+
+    # The forms don't use CSRF protection, newer flask_wtf insists on a key otherwise
+    server.app.config['WTF_CSRF_ENABLED'] = False
+    client = server.app.test_client()
+    keys = [x.key for x in server.klog._entries]
+    rnd = random.Random(2)
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('%s: HTTP %d' % (url, response.status_code))
+
+    results.time('GET /list', lambda: get('/list'))
+    oldest = server.klog.years()[-1][0]
+    results.time('GET /list/<year>', lambda: get('/list/%d?fragment' % oldest))
+    results.time('GET /modify', lambda: get('/modify?id=%s' % rnd.choice(keys)))
+
+
+benchmarks = {
+    'core': bench_core,
+    'cache': bench_cache,
+    'mail': bench_mail,
+    'memory': bench_memory,
+    'parse': bench_parse,
+    'web': bench_web,
+}
+
+parser = argparse.ArgumentParser(description='klog - benchmarks on synthetic kitchenlogs')
+parser.add_argument('benchmark', choices=sorted(benchmarks) + ['all'], nargs='+', help='benchmarks to run')
+parser.add_argument('-e', '--entries', type=int, default=5000, help='number of entries')
+parser.add_argument('-w', '--words', type=int, default=80, help='words per entry')
+parser.add_argument('-m', '--media', type=int, default=2, help='maximum media per entry')
+parser.add_argument('-s', '--media-size', type=int, default=1024, help='size of a medium in bytes')
+parser.add_argument('-y', '--years', type=int, default=10, help='years covered by the log')
+parser.add_argument('-c', '--changes', type=int, default=10, help='entries changed for an incremental reload')
+parser.add_argument('-a', '--attachments', type=int, default=4, help='attachments per mail')
+parser.add_argument('-A', '--attachment-size', type=int, default=8 * 2**20, help='size of an attachment in bytes')
+parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per timing')
+parser.add_argument('-j', '--json', type=str, default=None, help='write results to this JSON file')
+args = parser.parse_args()
+
+selected = sorted(benchmarks) if 'all' in args.benchmark else args.benchmark
+report = {
+    'date': datetime.datetime.now().isoformat(),
+    'python': platform.python_version(),
+    'parameters': {x: y for x, y in vars(args).items() if x not in ['benchmark', 'json']},
+    'benchmarks': dict(),
+}
+
+for benchmark in selected:
+    # Benchmarks modify their repository, so each one gets a fresh one
+    with tempfile.TemporaryDirectory() as workdir:
+        print('== %s: generating %d entries...' % (benchmark, args.entries))
+        repo = generate(os.path.join(workdir, 'kitchenlog'), args.entries, args.words,
+                        args.media, args.media_size, args.years)
+        results = Results(args.repeat)
+        benchmarks[benchmark](args, repo, workdir, results)
+        results.print()
+        report['benchmarks'][benchmark] = results.values
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % args.json)
@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+
+"""
+klog-check - Checks klog's components against local stand-ins
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+import argparse
+import datetime
+import email
+import git
+import http.server
+import os
+import quopri
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+base = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, base)
+
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from pyklog.KitchenLog import KitchenLog, mail_end_marker
+from pyklog.MailParser import MailParser
+from pyklog.Mailer import Mailer
+from pyklog.Publisher import Publisher
+from pyklog.RWLock import RWLock
+from pyklog.Trigger import UpdateTrigger
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+    print('  ok: %s' % message)
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+# Stands in for the wiki's update URL. The first `failing` requests get an
+# HTTP 500, each request takes `delay` seconds.
+class WikiStub(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, failing=0, delay=0):
+        self.failing = failing
+        self.delay = delay
+        self.requests = 0
+        self.lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), WikiHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class WikiHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            failing = self.server.requests <= self.server.failing
+        time.sleep(self.server.delay)
+        self.send_response(500 if failing else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def check_trigger(workdir):
+    wiki = WikiStub()
+    trigger = UpdateTrigger(wiki.url, debounce=0.2)
+    for _ in range(10):
+        trigger.fire()
+    check(trigger.flush(10), 'a burst of fires is flushed')
+    check(wiki.requests == 1, 'a burst of fires ends up in a single request')
+    wiki.shutdown()
+
+    wiki = WikiStub(failing=2)
+    trigger = UpdateTrigger(wiki.url, retries=3, backoff=0.05, debounce=0)
+    trigger.fire()
+    trigger.flush(10)
+    stats = trigger.stats()
+    check(wiki.requests == 3 and stats['retries'] == 2 and stats['failures'] == 0,
+          'failing requests are retried')
+    wiki.shutdown()
+
+    wiki = WikiStub(delay=1)
+    trigger = UpdateTrigger(wiki.url, timeout=0.2, retries=1, backoff=0.05, debounce=0)
+    start = time.monotonic()
+    trigger.fire()
+    trigger.flush(10)
+    stats = trigger.stats()
+    check(stats['failures'] == 1 and stats['last_error'], 'a hanging wiki counts as a failure')
+    check(time.monotonic() - start < 1.5, 'a hanging wiki is given up on after the timeout')
+    wiki.shutdown()
+
+
+# A minimal SMTP server that keeps the mails it receives. Replies to DATA
+# are taken from `answers` as long as there are any, e.g. 451 for a
+# transient failure, then it accepts everything.
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, answers=()):
+        self.answers = list(answers)
+        self.mails = list()
+        self.connections = 0
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 klog-check ESMTP')
+        for line in self.rfile:
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 klog-check')
+            elif command.startswith(('MAIL', 'RCPT', 'RSET', 'NOOP')):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = list()
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    answer = self.server.answers.pop(0) if self.server.answers else '250 OK'
+                    if answer.startswith('250'):
+                        self.server.mails.append(b''.join(data))
+                self.reply(answer)
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+def reply(no):
+    msg = MIMEText('Reply %d' % no)
+    msg['From'] = 'klog@localhost'
+    msg['To'] = 'someone@localhost'
+    msg['Subject'] = 'Re: check %d' % no
+    return msg
+
+
+def check_mailer(workdir):
+    smtp = SMTPStub()
+    mailer = Mailer(smtp.address, retry_delay=0.05)
+    for no in range(5):
+        mailer.send(reply(no))
+    mailer.flush()
+    check(len(smtp.mails) == 5 and mailer.stats()['sent'] == 5, 'queued replies are delivered')
+    check(smtp.connections == 1, 'replies share a single connection')
+    mailer.close()
+    smtp.shutdown()
+
+    smtp = SMTPStub(['451 Try again later', '451 Try again later'])
+    mailer = Mailer(smtp.address, retries=3, retry_delay=0.05)
+    mailer.send(reply(0))
+    mailer.flush()
+    check(len(smtp.mails) == 1 and mailer.stats()['failures'] == 0, 'transient failures are retried')
+    mailer.close()
+    smtp.shutdown()
+
+    smtp = SMTPStub(['550 No such user'])
+    mailer = Mailer(smtp.address, retries=3, retry_delay=0.05)
+    mailer.send(reply(0))
+    mailer.send(reply(1))
+    mailer.flush()
+    stats = mailer.stats()
+    check(stats['failures'] == 1 and stats['sent'] == 1 and len(smtp.mails) == 1,
+          'refused replies are not retried and don\'t hold up others')
+    mailer.close()
+    smtp.shutdown()
+
+    smtp = SMTPStub()
+    mailer = Mailer(smtp.address, idle_timeout=0.2)
+    mailer.send(reply(0))
+    mailer.flush()
+    time.sleep(0.5)
+    mailer.send(reply(1))
+    mailer.flush()
+    check(len(smtp.mails) == 2 and smtp.connections == 2, 'idle connections are closed and reopened')
+    mailer.close()
+    smtp.shutdown()
+
+
+def identify(repo):
+    with repo.config_writer() as config:
+        config.set_value('user', 'name', 'klog check')
+        config.set_value('user', 'email', 'klog@localhost')
+
+
+def commit(repo, name):
+    with open(os.path.join(repo.working_dir, name), 'w') as f:
+        f.write(name)
+    repo.git.add('-A')
+    repo.git.commit('-m', name)
+
+
+def check_publisher(workdir):
+    remote = git.Repo.init(os.path.join(workdir, 'remote.git'), bare=True)
+    repo = git.Repo.init(os.path.join(workdir, 'kitchenlog'))
+    identify(repo)
+    repo.git.remote('add', 'origin', remote.git_dir)
+    commit(repo, 'initial')
+    repo.git.push('-u', 'origin', 'HEAD')
+
+    def published():
+        return remote.head.commit == repo.head.commit
+
+    triggered = list()
+    publisher = Publisher(repo, lambda: triggered.append(True), merge_delay=0.5, retry_delay=0.2)
+    for no in range(3):
+        commit(repo, 'burst %d' % no)
+        publisher.schedule('burst %d' % no)
+    check(wait_for(lambda: not publisher.status()['pending']), 'a burst of commits is published')
+    check(published(), 'the remote has all commits')
+    check(publisher.status()['pushes'] == 1 and len(triggered) == 1,
+          'a burst of commits ends up in a single push')
+
+    # The remote refuses pushes until the hook is gone
+    hook = os.path.join(remote.git_dir, 'hooks', 'pre-receive')
+    with open(hook, 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(hook, 0o755)
+    commit(repo, 'refused')
+    publisher.schedule('refused')
+    check(wait_for(lambda: publisher.status()['failures'] > 0), 'a refused push is noticed')
+    check(publisher.status()['pending'] and publisher.status()['last_error'], 'a refused push stays pending')
+    os.remove(hook)
+    check(wait_for(lambda: not publisher.status()['pending']), 'a refused push is retried')
+    check(published() and publisher.status()['last_error'] is None, 'the retried push publishes the commit')
+
+    # Someone else pushed meanwhile, retry() skips the retry delay
+    publisher = Publisher(repo, merge_delay=0, retry_delay=600)
+    other = git.Repo.clone_from(remote.git_dir, os.path.join(workdir, 'other'))
+    identify(other)
+    commit(other, 'other')
+    other.git.push()
+    commit(repo, 'behind')
+    publisher.schedule('behind')
+    check(wait_for(lambda: publisher.status()['failures'] > 0), 'a non-fast-forward push is refused')
+    repo.git.pull('--no-edit', '--no-rebase')
+    publisher.retry()
+    check(wait_for(lambda: not publisher.status()['pending']), 'retry() pushes without waiting for the delay')
+    check(published(), 'the remote has the merged commits')
+
+
+entry_template = \
+"""BEGIN: %s
+END: None
+TOPIC: %s
+APPENDIX: None
+
+%s
+"""
+
+
+def kitchenlog(workdir):
+    repo = git.Repo.init(os.path.join(workdir, 'kitchenlog'))
+    identify(repo)
+    os.makedirs(os.path.join(repo.working_dir, '2018', '01'))
+    with open(os.path.join(repo.working_dir, '2018', '01', '01-0.txt'), 'w') as f:
+        f.write(entry_template % ('2018-01-01', 'First', '  * first'))
+    repo.git.add('-A')
+    repo.git.commit('-m', 'initial')
+    os.makedirs(os.path.join(workdir, 'cache'))
+    return KitchenLog(repo, os.path.join(workdir, 'cache'))
+
+
+def new_mail(date, topic, image=None):
+    mail = MIMEMultipart()
+    mail['From'] = 'Check <check@localhost>'
+    mail['Subject'] = 'new'
+    mail.attach(MIMEText(entry_template % (date, topic, '  * %s' % topic) + '\n' + mail_end_marker + '\n'))
+    if image:
+        mail.attach(image)
+    return mail.as_bytes()
+
+
+def check_mail(workdir):
+    klog = kitchenlog(workdir)
+    image = MIMEImage(os.urandom(4096), 'jpeg')
+    image.add_header('Content-Disposition', 'attachment', filename='image.jpg')
+
+    update, _ = klog.handle_email('klog@localhost', new_mail('2018-02-02', 'Mail', image))
+    check(update, 'a mail with an attachment adds an entry')
+    klog.commit('Mail', no_sync=True)
+    entry = klog.get(datetime.datetime(2018, 2, 2))[0]
+    check(entry.media == ['image.jpg'], 'the attachment is saved as media')
+    media = os.path.join(klog.repo.working_dir, entry.media_path('image.jpg'))
+    with open(media, 'rb') as f:
+        check(f.read() == image.get_payload(decode=True), 'the media holds the attachment')
+    check(os.stat(media).st_mode & stat.S_IROTH, 'mailed media are world-readable')
+
+    # Saving the second entry fails after its file was written
+    put = klog._media_store.put
+
+    def fail(*args, **kwargs):
+        raise OSError('No space left on device')
+    klog._media_store.put = fail
+    try:
+        update, responses, failed = klog.handle_emails('klog@localhost', [
+            new_mail('2018-03-03', 'Saved'), new_mail('2018-04-04', 'Failed', image)])
+    finally:
+        klog._media_store.put = put
+    check(update and failed == [1], 'a mail whose entry fails to save is reported')
+    klog.commit('Batch', no_sync=True)
+    committed = klog.repo.git.show('--name-only', '--format=', 'HEAD').split('\n')
+    check('2018/03/03-0.txt' in committed, 'the other mails of the batch are committed')
+    check(not [x for x in committed if '2018/04' in x or '2018-04' in x] and
+          not klog.repo.git.status('--porcelain', '--untracked-files=all'),
+          'nothing of the failed mail is left behind')
+    check(not klog.get(datetime.datetime(2018, 4, 4)), 'the failed entry is not in the log')
+
+
+def sample_mail():
+    # Nested multipart with text, base64 and quoted-printable bodies
+    mail = MIMEMultipart()
+    mail['From'] = 'Check <check@localhost>'
+    mail['Subject'] = 'new'
+    text = MIMEMultipart('alternative')
+    text.attach(MIMEText('Grüße aus der Küche\n' + 'lang ' * 40 + '\n', 'plain', 'utf-8'))
+    text.attach(MIMEText('<p>Grüße aus der Küche</p>\n', 'html', 'utf-8'))
+    mail.attach(text)
+    # Latin-1 text is sent quoted-printable
+    mail.attach(MIMEText('ümlaut = und lange Zeilen ' * 10 + '\n', 'plain', 'iso-8859-1'))
+    image = MIMEImage(os.urandom(5000), 'jpeg')
+    image.add_header('Content-Disposition', 'attachment', filename='image.jpg')
+    mail.attach(image)
+    document = MIMEApplication(bytes(range(256)) * 20 + b'= trailing =\n', 'octet-stream', email.encoders.encode_noop)
+    document['Content-Transfer-Encoding'] = 'quoted-printable'
+    document.set_payload(quopri.encodestring(bytes(range(256)) * 20 + b'= trailing =\n').decode('ascii'))
+    document.add_header('Content-Disposition', 'attachment', filename='document.bin')
+    mail.attach(document)
+    return mail.as_bytes()
+
+
+def compare_parsers(workdir, raw, chunk_size):
+    # Returns why MailParser's result differs from the stdlib's, or None
+    expected = [x for x in email.message_from_bytes(raw).walk()]
+    parsed = MailParser(workdir, chunk_size).parse(raw)
+    try:
+        actual = [x for x in parsed.walk()]
+        if len(actual) != len(expected):
+            return '%d parts instead of %d' % (len(actual), len(expected))
+        for no, (ours, theirs) in enumerate(zip(actual, expected)):
+            if ours.items() != theirs.items():
+                return 'headers of part %d differ' % no
+            if theirs.is_multipart():
+                continue
+            if ours.staged:
+                with open(ours.staged, 'rb') as f:
+                    payload = f.read()
+            else:
+                payload = ours.get_payload(decode=True)
+            if payload != theirs.get_payload(decode=True):
+                return 'payload of part %d (%s) differs' % (no, theirs.get_content_type())
+    finally:
+        parsed.drop_staged()
+    return None
+
+
+def check_mailparser(workdir):
+    raw = sample_mail()
+    boundary = email.message_from_bytes(raw).get_boundary().encode()
+    variants = {
+        'LF': raw,
+        'CRLF': raw.replace(b'\n', b'\r\n'),
+        'a missing final boundary': raw[:raw.rindex(b'--' + boundary + b'--')],
+        'a single text part': MIMEText('Grüße\n  * aus der Küche\n', 'plain', 'utf-8').as_bytes(),
+        'a single binary part': MIMEImage(os.urandom(1000), 'png').as_bytes(),
+    }
+    for name, mail in variants.items():
+        for chunk_size in [100, 1 << 16]:
+            difference = compare_parsers(workdir, mail, chunk_size)
+            check(difference is None, 'a mail with %s parses like the stdlib does, %d byte chunks%s' %
+                  (name, chunk_size, ': %s' % difference if difference else ''))
+    check(not os.listdir(workdir), 'no staged files are left behind')
+
+
+def in_thread(function, *args):
+    # Runs function in the background, the event tells whether it returned
+    done = threading.Event()
+
+    def run():
+        function(*args)
+        done.set()
+    threading.Thread(target=run, daemon=True).start()
+    return done
+
+
+def hold(acquire):
+    # Takes a lock in the background until the returned event is set
+    held = threading.Event()
+    release_it = threading.Event()
+
+    def run():
+        with acquire():
+            held.set()
+            release_it.wait()
+    threading.Thread(target=run, daemon=True).start()
+    held.wait(5)
+    return release_it
+
+
+def check_lock(workdir):
+    klog = kitchenlog(workdir)
+
+    def nested():
+        with klog.reading(), klog.reading():
+            pass
+        with klog.writing(), klog.writing(), klog.editing(), klog.editing(), klog.reading():
+            pass
+    check(in_thread(nested).wait(5), 'reading(), writing() and editing() are reentrant')
+
+    upgraded = list()
+
+    def upgrade():
+        with klog.reading():
+            try:
+                with klog.editing():
+                    upgraded.append(True)
+            except RuntimeError:
+                upgraded.append(False)
+    check(in_thread(upgrade).wait(5) and upgraded == [False], 'upgrading a shared lock raises RuntimeError')
+    check(in_thread(nested).wait(5), 'a failed upgrade leaves the locks free')
+
+    release = hold(klog.editing)
+    def read_log():
+        with klog.reading():
+            pass
+    reader = in_thread(read_log)
+    check(not reader.wait(0.3), 'editing() blocks readers')
+    release.set()
+    check(reader.wait(5), 'readers continue once editing is done')
+
+    lock = RWLock()
+    order = list()
+    release = hold(lock.shared)
+
+    def write():
+        with lock.exclusive():
+            order.append('writer')
+
+    def read():
+        with lock.shared():
+            order.append('reader')
+    writer = in_thread(write)
+    check(wait_for(lambda: lock._waiting == 1, 5), 'a writer waits for a reader')
+    reader = in_thread(read)
+    check(not reader.wait(0.3), 'a waiting writer blocks new readers')
+    release.set()
+    check(writer.wait(5) and reader.wait(5) and order == ['writer', 'reader'],
+          'the waiting writer goes before new readers')
+
+
+checks = {
+    'lock': check_lock,
+    'mail': check_mail,
+    'mailer': check_mailer,
+    'mailparser': check_mailparser,
+    'publisher': check_publisher,
+    'trigger': check_trigger,
+}
+
+parser = argparse.ArgumentParser(description='klog - checks of the background workers')
+parser.add_argument('check', choices=sorted(checks) + ['all'], nargs='+', help='checks to run')
+args = parser.parse_args()
+
+selected = sorted(checks) if 'all' in args.check else args.check
+failed = list()
+for name in selected:
+    print('== %s' % name)
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            checks[name](workdir)
+        except CheckFailed as e:
+            print('  FAILED: %s' % str(e))
+            failed.append(name)
+        except Exception:
+            traceback.print_exc()
+            failed.append(name)
+
+if failed:
+    print('Failed: %s' % ', '.join(failed))
+    sys.exit(1)
+print('All checks passed')
@@ -1,18 +1,9 @@
 #!/bin/bash
 
 USER=klog
-KLOG=/home/${USER}/klog/klog
+KLOGD=/home/${USER}/klog/klogd
 
 export LANG=en_US.UTF-8
 
-TMP=$(mktemp)
-
-chmod a+r $TMP
-cat > $TMP
-
-sudo -u $USER $KLOG --from-email $TMP
-ret=$?
-
-rm $TMP
-
-exit $ret
+# Hand the mail over to the running klogd
+exec sudo -u $USER $KLOGD --submit
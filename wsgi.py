@@ -0,0 +1,24 @@
+"""
+klog - Binary Kitchen's log tool
+
+Copyright (c) Binary Kitchen e.V., 2018
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the LICENSE file in the top-level directory.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+"""
+
+# WSGI entry point, e.g. for
+#
+#   waitress-serve --threads 8 --port 8080 wsgi:application
+#   gunicorn --workers 1 --threads 8 --bind 0.0.0.0:8080 wsgi:application
+#
+# Every process picks up the commits of the others before handling a request,
+# but writes of several processes may still run into each other in the working
+# tree. Prefer a single process with as many threads as needed.
+
+from server import app as application